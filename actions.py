@@ -9,6 +9,7 @@ import re
 import smtplib
 import requests
 import urllib
+from publisher import ResponseBatch, get_response_destination
 
 
 def execute_function(name, parameters, data, configs):
@@ -45,7 +46,8 @@ def perform_action(actions, data, configs, channel):
     :param actions:
     :param data:
     :param configs:
-    :param channel:
+    :param channel: a pika channel, a publisher.Publisher, or a publisher.ResponseBatch to publish the responses of the
+    turn together
     :return:
     '''
     # safety - hence using a copy
@@ -70,6 +72,7 @@ def perform_action(actions, data, configs, channel):
             get_result = action["api"].get("get_result", True)
             result_action = action["api"].get("result_action", [])
             # call the API and get the result
+            flush_responses(channel)
             result = call_api(action["api"], data) or {}
             if get_result:
                 # set the variables in data
@@ -123,8 +126,10 @@ def perform_action(actions, data, configs, channel):
         # Call function using arguments
         elif "send_email" in action:
             r_type = "email"
+            flush_responses(channel)
             response = execute_function(action["function"], action["args"], data, configs)
         elif "function" in action:
+            flush_responses(channel)
             response = execute_function(action["function"], action["args"], data, configs)
         if response:
             responses.append(response)
@@ -144,16 +149,28 @@ def perform_action(actions, data, configs, channel):
                                       routing_key=configs["celery"]["SEND_EMAIL"],
                                       body=json.dumps(payload))
             else:
-                # send rabbit messages
-                # Adding square brackets to the payload as per format
-                print payload
-                channel.basic_publish(exchange="",
-                                      routing_key=configs["celery"]["CHAT_TO_FB"] + "_" + payload["s_id"] + "_" + payload["c_id"],
-                                      body=json.dumps([payload]))
+                exchange, routing_key = get_response_destination(configs["celery"], payload["s_id"], payload["c_id"])
+                if isinstance(channel, ResponseBatch):
+                    # published with the rest of the turn's responses
+                    channel.add(exchange, routing_key, payload)
+                else:
+                    # send rabbit messages
+                    # Adding square brackets to the payload as per format
+                    print payload
+                    channel.basic_publish(exchange=exchange,
+                                          routing_key=routing_key,
+                                          body=json.dumps([payload]))
 
     return responses, move
 
 
+def flush_responses(channel):
+    # publishes the responses batched so far before an action that can block, so that they are not held back for as
+    # long as it takes, whatever the latency budget
+    if isinstance(channel, ResponseBatch):
+        channel.flush()
+
+
 def substitute_placeholders(text, action, data):
     # TODO Placeholders are obsolete. Phase them out
     placeholders = action.get("placeholders", [])
@@ -209,6 +226,50 @@ def call_api(api_object, data):
             return json.loads("{}")
 
 
+# Operations supported by JSON Logic. Every operation takes the data being evaluated and the action utils as its first
+# arguments, followed by the evaluated values of the test. Built once rather than on every evaluation.
+logic_operations = {
+    "==": (lambda data, action_utils, a, b: a == b),
+    "===": (lambda data, action_utils, a, b: a is b),
+    "!=": (lambda data, action_utils, a, b: a != b),
+    "!==": (lambda data, action_utils, a, b: a is not b),
+    ">": (lambda data, action_utils, a, b: a > b),
+    ">=": (lambda data, action_utils, a, b: a >= b),
+    "<": (lambda data, action_utils, a, b, c=None: a < b if (c is None) else (a < b) and (b < c)),
+    "<=": (lambda data, action_utils, a, b, c=None: a <= b if (c is None) else (a <= b) and (b <= c)),
+    "!": (lambda data, action_utils, a: not a),
+    "%": (lambda data, action_utils, a, b: a % b),
+    "and": (lambda data, action_utils, *args: reduce(lambda total, arg: total and arg, args, True)),
+    "or": (lambda data, action_utils, *args: reduce(lambda total, arg: total or arg, args, False)),
+    "?:": (lambda data, action_utils, a, b, c: b if a else c),
+    "log": (lambda data, action_utils, a: a if sys.stdout.write(str(a)) else a),
+    "in": (lambda data, action_utils, a, b: a in b if "__contains__" in dir(b) else False),
+    "var": (lambda data, action_utils, a, not_found=None:
+            reduce(lambda data, key: (data.get(key, not_found)
+                                      if type(data) == dict
+                                      else data[int(key)]
+            if type(data) in [list, tuple]
+            else not_found),
+                   str(a).split("."),
+                   data)),
+    "cat": (lambda data, action_utils, *args: "".join(args)),
+    "+": (lambda data, action_utils, *args: reduce(lambda total, arg: total + float(arg), args, 0.0)),
+    "*": (lambda data, action_utils, *args: reduce(lambda total, arg: total * float(arg), args, 1.0)),
+    "-": (lambda data, action_utils, a, b=None: -a if b is None else a - b),
+    "/": (lambda data, action_utils, a, b=None: a if b is None else float(a) / float(b)),
+    "min": (lambda data, action_utils, *args: min(args)),
+    "max": (lambda data, action_utils, *args: max(args)),
+    "function": (lambda data, action_utils, *args: execute_function(args[0], args[1], data.get('context', None), action_utils)),
+    "regex": (lambda data, action_utils, x, y: re.match(x, y)),
+    "fuzzy": (lambda data, action_utils, x, y: utils.fuzzy_text_matcher(x, y)),
+    "fuzzyMessage": (lambda data, action_utils, x: utils.fuzzy_text_matcher(data.get('message', ""), x) > action_utils["min_fuzzy_prob"]),
+    "class": (lambda data, action_utils, x: utils.class_check(data.get("message", ""), x, action_utils)),
+    "bool": (lambda data, action_utils, a: bool(a)),
+    "extract": (lambda data, action_utils, *x: utils.perform_extraction(x, data)),
+    "count": (lambda data, action_utils, *x: utils.length(x))
+}
+
+
 def json_logic(tests, data=None, action_utils=dict()):
     '''
     Evaluate JSON Logic. The matching conditions are stored in JSON
@@ -227,48 +288,8 @@ def json_logic(tests, data=None, action_utils=dict()):
 
     op = tests.keys()[0]
     values = tests[op]
-    operations = {
-        "==": (lambda a, b: a == b),
-        "===": (lambda a, b: a is b),
-        "!=": (lambda a, b: a != b),
-        "!==": (lambda a, b: a is not b),
-        ">": (lambda a, b: a > b),
-        ">=": (lambda a, b: a >= b),
-        "<": (lambda a, b, c=None: a < b if (c is None) else (a < b) and (b < c)),
-        "<=": (lambda a, b, c=None: a <= b if (c is None) else (a <= b) and (b <= c)),
-        "!": (lambda a: not a),
-        "%": (lambda a, b: a % b),
-        "and": (lambda *args: reduce(lambda total, arg: total and arg, args, True)),
-        "or": (lambda *args: reduce(lambda total, arg: total or arg, args, False)),
-        "?:": (lambda a, b, c: b if a else c),
-        "log": (lambda a: a if sys.stdout.write(str(a)) else a),
-        "in": (lambda a, b: a in b if "__contains__" in dir(b) else False),
-        "var": (lambda a, not_found=None:
-                reduce(lambda data, key: (data.get(key, not_found)
-                                          if type(data) == dict
-                                          else data[int(key)]
-                if type(data) in [list, tuple]
-                else not_found),
-                       str(a).split("."),
-                       data)),
-        "cat": (lambda *args: "".join(args)),
-        "+": (lambda *args: reduce(lambda total, arg: total + float(arg), args, 0.0)),
-        "*": (lambda *args: reduce(lambda total, arg: total * float(arg), args, 1.0)),
-        "-": (lambda a, b=None: -a if b is None else a - b),
-        "/": (lambda a, b=None: a if b is None else float(a) / float(b)),
-        "min": (lambda *args: min(args)),
-        "max": (lambda *args: max(args)),
-        "function": (lambda *args: execute_function(args[0], args[1], data.get('context', None), action_utils)),
-        "regex": (lambda x, y: re.match(x, y)),
-        "fuzzy": (lambda x, y: utils.fuzzy_text_matcher(x, y)),
-        "fuzzyMessage": (lambda x: utils.fuzzy_text_matcher(data.get('message', ""), x) > action_utils["min_fuzzy_prob"]),
-        "class": (lambda x: utils.class_check(data.get("message", ""), x, action_utils)),
-        "bool": (lambda a: bool(a)),
-        "extract": (lambda *x: utils.perform_extraction(x, data)),
-        "count": (lambda *x: utils.length(x))
-    }
 
-    if op not in operations:
+    if op not in logic_operations:
         raise RuntimeError("Unrecognized operation %s" % op)
 
     # Easy syntax for unary operators, like {"var": "x"} instead of strict
@@ -276,10 +297,17 @@ def json_logic(tests, data=None, action_utils=dict()):
     if type(values) not in [list, tuple]:
         values = [values]
 
+    # Short-circuit: evaluate values only as far as the operation needs them
+    if op in utils.short_circuit_operations:
+        try:
+            return utils.short_circuit_operations[op](lambda val: json_logic(val, data, action_utils), values)
+        except RuntimeError:
+            return logic_operations[op](data, action_utils, *values)
+
     # Recursion!
     try:
-        values = map(lambda val: json_logic(val, data), values)
+        values = map(lambda val: json_logic(val, data, action_utils), values)
     except RuntimeError:
         pass
 
-    return operations[op](*values)
+    return logic_operations[op](data, action_utils, *values)
@@ -0,0 +1,22 @@
+import sys
+import time
+import utils
+from test_clean_text import legacy_remove_non_alpha_num_chars, representative_texts, get_random_texts
+
+# Use this to compare the speed of utils.remove_non_alpha_num_chars with the implementation it replaced.
+# usage: python benchmark_clean_text.py [messages] [rounds]
+
+num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+texts = (representative_texts * (num_messages / len(representative_texts) + 1))[:num_messages / 2]
+texts += get_random_texts(num_messages - len(texts))
+
+for name, function in [("previous", legacy_remove_non_alpha_num_chars),
+                       ("clean_text", utils.remove_non_alpha_num_chars)]:
+    timings = []
+    for i in xrange(num_rounds):
+        started_at = time.time()
+        for text in texts:
+            function(text)
+        timings.append(time.time() - started_at)
+    print "%s: best %.3fs, mean %.3fs for %d messages" % (name, min(timings), sum(timings) / len(timings), len(texts))
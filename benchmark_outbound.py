@@ -0,0 +1,71 @@
+import sys
+import time
+import json
+import pika
+import requests
+from publisher import get_response_destination, get_partition_queue
+
+# Use this to compare the "queue" and "topic" outbound modes under load: publish throughput, the number of queues and
+# the memory used by the broker. Needs a local RabbitMQ with the management plugin.
+# usage: python benchmark_outbound.py [users] [messages per user] [partitions]
+
+num_users = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+messages_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+num_partitions = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+management_url = "http://localhost:15672/api/"
+management_auth = ("guest", "guest")
+celery_configs = {
+    "CHAT_TO_FB": "BENCHMARK_CHAT_TO_FB",
+    "OUTBOUND_EXCHANGE": "BENCHMARK_CHAT_TO_FB_OUT",
+    "OUTBOUND_PARTITIONS": num_partitions
+}
+
+
+def get_broker_memory():
+    nodes = requests.get(management_url + "nodes", auth=management_auth).json()
+    return sum(node["mem_used"] for node in nodes)
+
+
+def declare(channel, mode):
+    # the queues a consumer of responses would declare. Returns their names
+    if mode == "topic":
+        channel.exchange_declare(exchange=celery_configs["OUTBOUND_EXCHANGE"], exchange_type="topic")
+        queues = []
+        for partition in xrange(num_partitions):
+            queue = get_partition_queue(celery_configs, partition)
+            channel.queue_declare(queue=queue, arguments={"x-single-active-consumer": True})
+            channel.queue_bind(queue=queue, exchange=celery_configs["OUTBOUND_EXCHANGE"],
+                               routing_key="%s.%d.#" % (celery_configs["CHAT_TO_FB"], partition))
+            queues.append(queue)
+        return queues
+    queues = []
+    for user in xrange(num_users):
+        queues.append(get_response_destination(celery_configs, str(user), "company")[1])
+        channel.queue_declare(queue=queues[-1])
+    return queues
+
+
+connection = pika.BlockingConnection(pika.ConnectionParameters("localhost"))
+channel = connection.channel()
+for mode in ["queue", "topic"]:
+    celery_configs["OUTBOUND_MODE"] = mode
+    memory_before = get_broker_memory()
+    started_at = time.time()
+    queues = declare(channel, mode)
+    declared_at = time.time()
+    for i in xrange(messages_per_user):
+        for user in xrange(num_users):
+            exchange, routing_key = get_response_destination(celery_configs, str(user), "company")
+            channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                  body=json.dumps([{"s_id": str(user), "c_id": "company", "response": "load test"}]))
+    published_at = time.time()
+    # let the broker catch up before reading its memory
+    time.sleep(5)
+    print "%s: %d queues declared in %.1fs, %.0f messages/s, broker memory +%.1f MB" % (
+        mode, len(queues), declared_at - started_at,
+        num_users * messages_per_user / (published_at - declared_at), (get_broker_memory() - memory_before) / 1e6)
+    for queue in queues:
+        channel.queue_delete(queue=queue)
+    if mode == "topic":
+        channel.exchange_delete(exchange=celery_configs["OUTBOUND_EXCHANGE"])
+connection.close()
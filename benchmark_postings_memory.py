@@ -0,0 +1,78 @@
+import os
+import sys
+import random
+import multiprocessing
+from array import array
+from postings import Postings
+
+# Use this to compare the memory used by the postings of a synthetic index with the current PostingsNode, which keeps
+# its docs in __slots__ and array columns, and with the previous one, which kept a dict per posting.
+# Each index is built in its own process, and its footprint is the growth of the process's resident memory (Linux).
+# usage: python benchmark_postings_memory.py [docs] [tokens per doc] [vocabulary size]
+
+num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+tokens_per_doc = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+vocabulary_size = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+
+
+class LegacyPostingsNode:
+    # PostingsNode before the array columns
+    def __init__(self, token):
+        self.token = token
+        self.features = {}
+        self.doc_list = []
+        self.doc_id_set = set()
+        self.impact_doc_ids = []
+        self.impacts = array('d')
+        self.doc_id_array = None
+
+
+def get_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_postings():
+    # the same (token, doc id, tf) postings on every run
+    rng = random.Random(0)
+    for doc_id in xrange(num_docs):
+        for token_id in rng.sample(xrange(vocabulary_size), tokens_per_doc):
+            yield "token%d" % token_id, doc_id, rng.randint(1, 3)
+
+
+def build_legacy():
+    collection = {}
+    for token, doc_id, tf in get_postings():
+        node = collection.get(token)
+        if not node:
+            node = collection[token] = LegacyPostingsNode(token)
+        # with the tf-idf that compute_tf_idf added to the features
+        node.doc_list.append({"id": doc_id, "features": {"tf": tf, "tf-idf": 0.0}})
+    return collection
+
+
+def build_current():
+    postings = Postings()
+    for token, doc_id, tf in get_postings():
+        postings.add_document_for_token(token, doc_id, {"tf": tf})
+    return postings
+
+
+def measure(build, results):
+    rss_before = get_rss()
+    index = build()
+    results.put(get_rss() - rss_before)
+
+
+if __name__ == '__main__':
+    print "%d postings (%d docs x %d tokens, %d distinct tokens)" % (num_docs * tokens_per_doc, num_docs,
+                                                                     tokens_per_doc, vocabulary_size)
+    footprints = {}
+    for name, build in [("dict per posting", build_legacy), ("array columns", build_current)]:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(build, results))
+        process.start()
+        footprints[name] = results.get()
+        process.join()
+        print "%s: %.1f MB" % (name, footprints[name] / 1e6)
+    print "%.1fx smaller" % (float(footprints["dict per posting"]) / footprints["array columns"])
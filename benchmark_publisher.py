@@ -0,0 +1,70 @@
+import sys
+import time
+import json
+import pika
+from publisher import Publisher
+
+# Use this to compare the latency of publishing a turn's responses on a new connection per turn, as chat_from_fb used
+# to, with the worker's long-lived publisher. Needs a local RabbitMQ.
+# usage: python benchmark_publisher.py [turns] [responses per turn]
+
+celery_configs = {
+    "RABBIT_USR": "guest",
+    "RABBIT_PASS": "guest",
+    "RABBIT_PORT": 5672,
+    "RABBIT_IP": "localhost",
+    "RABBIT_VHOST": "/",
+    "RABBIT_SCKT_TIMEOUT": 2
+}
+queue = "BENCHMARK_PUBLISHER"
+num_turns = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+responses_per_turn = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+body = json.dumps([{"m_id": "m", "s_id": "s", "c_id": "c", "response": "benchmark response"}])
+
+
+def connection_per_turn():
+    credentials = pika.PlainCredentials(celery_configs["RABBIT_USR"], celery_configs["RABBIT_PASS"])
+    parameters = pika.ConnectionParameters(celery_configs["RABBIT_IP"],
+                                           celery_configs["RABBIT_PORT"],
+                                           celery_configs["RABBIT_VHOST"],
+                                           credentials,
+                                           socket_timeout=celery_configs["RABBIT_SCKT_TIMEOUT"])
+    broker_connection = pika.BlockingConnection(parameters)
+    channel = broker_connection.channel()
+    for i in xrange(responses_per_turn):
+        channel.basic_publish(exchange="", routing_key=queue, body=body)
+    broker_connection.close()
+
+
+def long_lived(publisher):
+    for i in xrange(responses_per_turn):
+        publisher.basic_publish(exchange="", routing_key=queue, body=body)
+
+
+def report(name, latencies):
+    latencies.sort()
+    print "%s: mean %.2fms, p50 %.2fms, p99 %.2fms" % (name, 1000 * sum(latencies) / len(latencies),
+                                                      1000 * latencies[len(latencies) / 2],
+                                                      1000 * latencies[int(len(latencies) * 0.99)])
+
+
+setup_connection = pika.BlockingConnection(pika.ConnectionParameters(celery_configs["RABBIT_IP"]))
+setup_channel = setup_connection.channel()
+setup_channel.queue_declare(queue=queue)
+
+publisher = Publisher(celery_configs)
+confirming_publisher = Publisher(dict(celery_configs, RABBIT_CONFIRM_DELIVERY=True))
+for name, turn in [("connection per turn", connection_per_turn),
+                   ("long-lived publisher", lambda: long_lived(publisher)),
+                   ("long-lived publisher with confirms", lambda: long_lived(confirming_publisher))]:
+    latencies = []
+    for i in xrange(num_turns):
+        started_at = time.time()
+        turn()
+        latencies.append(time.time() - started_at)
+    report(name, latencies)
+publisher.close()
+confirming_publisher.close()
+
+setup_channel.queue_delete(queue=queue)
+setup_connection.close()
@@ -4,17 +4,37 @@ import os
 from celery import Celery
 import json
 import pika
+from functools import partial
 from celery import bootsteps
+from billiard.exceptions import WorkerLostError
 from kombu import Consumer, Exchange, Queue
+from publisher import get_partition_queue, get_partition_task_queue
+from sessions import HashRing, get_session_key, get_shard_queues
+
+
+def run_chat_from_fb(body):
+    # runs a turn in a process of the worker's pool, in the "direct" ingestion mode
+    app.tasks["tasks.chat_from_fb"](body)
+
+
+def get_turn_queue(body):
+    # the shard queue of the user of a chat message, or None for the default queue when turns are not sharded
+    if turn_ring is None:
+        return None
+    body_json = json.loads(body)
+    return turn_ring.get_node(get_session_key(body_json.get("c_id", ""), body_json.get("sender_id", "")))
 
 
 class MyConsumerStep(bootsteps.ConsumerStep):
 
+    def start(self, c):
+        # the worker's pool, which turns are run on in the "direct" ingestion mode
+        self.pool = c.pool
+        self.connection = c.connection
+        super(MyConsumerStep, self).start(c)
+
     def get_consumers(self, channel):
-        return [Consumer(channel,
-                         queues=[chat_from_fb],
-                         callbacks=[self.handle_message],
-                         accept=['json']),
+        return [self.get_ingestion_consumer(channel),
                 Consumer(channel,
                          queues=[test_queue],
                          callbacks=[self.handle_test_message],
@@ -27,12 +47,58 @@ class MyConsumerStep(bootsteps.ConsumerStep):
                          queues=[send_email],
                          callbacks=[self.handle_sending_email],
                          accept=['json'])
-                ]
+                ] + self.get_partition_consumers(channel)
+
+    def get_ingestion_consumer(self, channel):
+        if ingestion_mode != "direct":
+            return Consumer(channel,
+                            queues=[chat_from_fb],
+                            callbacks=[self.handle_message],
+                            accept=['json'])
+        # on its own channel, so that the prefetch limit only applies to chat messages. The step closes the channels
+        # of its consumers when it stops
+        return Consumer(self.connection.channel(),
+                        queues=[chat_from_fb],
+                        callbacks=[self.handle_message],
+                        accept=['json'],
+                        prefetch_count=ingestion_prefetch)
+
+    def get_partition_consumers(self, channel):
+        # responses published to the outbound topic exchange, with a consumer per partition queue. Only one of the
+        # consumers of a partition queue across the workers is active at a time, and its callbacks run one after the
+        # other, so a partition's responses are forwarded in the order they were published
+        consumers = []
+        for partition, queue in enumerate(chat_to_fb_partitions):
+            task_queue = get_partition_task_queue(configs["celery"], partition)
+            consumers.append(Consumer(channel,
+                                      queues=[queue],
+                                      callbacks=[partial(self.handle_partition_message, task_queue)],
+                                      accept=['json']))
+        return consumers
 
     def handle_message(self, body, message):
         print('Received chat message: {0!r}'.format(body))
+        if ingestion_mode == "direct" and turn_ring is None:
+            # The turn is run on the worker's pool instead of being sent back through the broker as a task, and the
+            # message is acked once it is done. A message whose worker dies before then is redelivered.
+            # The callbacks are run in the consumer's thread with the prefork and solo pools
+            self.pool.apply_async(run_chat_from_fb, args=(body,),
+                                  callback=lambda result: message.ack(),
+                                  error_callback=lambda error: self.handle_turn_error(body, message, error))
+            return
         message.ack()
-        app.send_task("tasks.chat_from_fb", [body])
+        app.send_task("tasks.chat_from_fb", [body], queue=get_turn_queue(body))
+
+    def handle_turn_error(self, body, message, error):
+        # A message whose turn raised is not requeued, so that one that always fails is not redelivered forever.
+        # One whose pool process died (eg. killed for memory) is requeued once, and dead-lettered if it is lost again
+        exception = getattr(error, "exception", error)
+        if isinstance(exception, WorkerLostError) and not message.delivery_info.get("redelivered"):
+            print('Lost chat message, requeued: {0!r}: {1!r}'.format(body, exception))
+            message.reject(requeue=True)
+            return
+        print('Failed chat message: {0!r}: {1!r}'.format(body, exception))
+        message.reject(requeue=False)
 
     def handle_test_message(self, body, message):
         print('Received test message: {0!r}'.format(body))
@@ -45,6 +111,11 @@ class MyConsumerStep(bootsteps.ConsumerStep):
         # Invoke sending task
         app.send_task("tasks.chat_to_fb", [body])
 
+    def handle_partition_message(self, task_queue, body, message):
+        message.ack()
+        # Invoke sending task on the partition's task queue, so that it is run after the ones sent before it
+        app.send_task("tasks.chat_to_fb", [body], queue=task_queue)
+
     def handle_sending_email(self, body, message):
         message.ack()
         # Invoke task to send email
@@ -71,6 +142,36 @@ chat_from_fb = Queue(configs["celery"]["CHAT_FROM_FB"], Exchange(configs["celery
 test_queue = Queue(configs["celery"]["TEST_TASK"], Exchange(configs["celery"]["TEST_TASK"]), configs["celery"]["TEST_TASK"])
 chat_to_fb = Queue(configs["celery"]["CHAT_TO_FB"], Exchange(configs["celery"]["CHAT_TO_FB"]), configs["celery"]["CHAT_TO_FB"])
 send_email = Queue(configs["celery"]["SEND_EMAIL"], Exchange(configs["celery"]["SEND_EMAIL"]), configs["celery"]["SEND_EMAIL"])
+# In the "topic" outbound mode, responses are published to a topic exchange that routes them to a fixed number of
+# queues, partitioned by sender id, instead of to a queue per conversation.
+# The partition queues are single active consumer queues, so that every worker can consume them but only one at a time
+# takes a partition's messages. Their chat_to_fb tasks are sent to a task queue per partition, which must be consumed
+# by a single worker process (-Q CHAT_TO_FB_PARTITION_<n>_TASKS -c 1), so that a sender's responses are sent in order.
+# Partition queues declared before without the argument must be deleted first, as the broker refuses to redeclare them
+chat_to_fb_partitions = []
+if configs["celery"].get("OUTBOUND_MODE", "queue") == "topic":
+    outbound_exchange = Exchange(configs["celery"]["OUTBOUND_EXCHANGE"], type="topic")
+    for partition in xrange(configs["celery"]["OUTBOUND_PARTITIONS"]):
+        chat_to_fb_partitions.append(Queue(get_partition_queue(configs["celery"], partition), outbound_exchange,
+                                           "%s.%d.#" % (configs["celery"]["CHAT_TO_FB"], partition),
+                                           queue_arguments={"x-single-active-consumer": True}))
+
+# In the "direct" ingestion mode, chat messages are run on the worker's pool straight from CHAT_FROM_FB, and at most
+# INGESTION_PREFETCH of them are taken from the broker at a time. In the "dispatch" mode they are sent to the pool as
+# tasks through the broker
+ingestion_mode = configs["celery"].get("INGESTION_MODE", "dispatch")
+ingestion_prefetch = None
+if ingestion_mode == "direct":
+    ingestion_prefetch = configs["celery"].get("INGESTION_PREFETCH", 8)
+
+# With TURN_SHARDS, the turns of a user are always sent to the same one of TURN_SHARDS queues, picked by consistent
+# hashing of the user. Each shard queue must be consumed by a single worker process
+# (celery -A celery_chat worker -Q CHAT_FROM_FB_SHARD_<n> -c 1), so that a user's turns are run in order, by one
+# process that can keep their session in memory. Sharded turns always go through the shard queues, in either
+# ingestion mode
+turn_ring = None
+if configs["celery"].get("TURN_SHARDS"):
+    turn_ring = HashRing(get_shard_queues(configs["celery"]))
 
 #  publish results to the following
 channel.queue_declare(queue=configs["celery"]["TEST_RESULT_TASK"], durable=True)
@@ -2,9 +2,47 @@ import sys
 import os
 import json
 import re
+import heapq
+import time
+import hashlib
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
 import utils
 import intents
-from postings import Postings
+from postings import Postings, MappedPostings
+
+
+def get_entry_texts(entry, fields_to_index):
+    # the non-empty texts of the indexed fields of a mapping entry
+    return filter(lambda x: bool(x), reduce(lambda x,y: x+y, [entry.get(field, []) or [] if type(entry.get(field, []) or []) == list else [str(entry[field])] for field in fields_to_index], []))
+
+
+def tokenize_mapping_entries(chunk):
+    '''
+    tokenizes entries of a mapping for both the postings and the tokenized mapping, in one pass over the entries.
+    Returns the sorted postings tokens and the tokenized elements of every entry, or (None, None) for inactive entries.
+    It is run by the indexing processes, so it takes a single argument
+    :param chunk: (entries, fields to index)
+    :return:
+    '''
+    entries, fields_to_index = chunk
+    tokenized = []
+    for entry in entries:
+        if not entry.get("active"):
+            tokenized.append((None, None))
+            continue
+        texts = get_entry_texts(entry, fields_to_index)
+        # the postings have the tokens of all the texts merged, lowercase
+        stripped_text = utils.clean_text(" ".join(texts))
+        tokens = set(utils.lemma_cache.get(word) for word in utils.clean_text(stripped_text.lower()).split())
+        # every text is tokenized separately for the tokenized mapping. These are the words that
+        # lemmatize_text(remove_non_alpha_num_chars(text)[0]) lemmatizes
+        tokenized_elements = [sorted(utils.lemma_cache.get(word) for word in utils.clean_text(utils.clean_text(text)).split())
+                              for text in texts]
+        tokenized.append((sorted(tokens), tokenized_elements))
+    return tokenized
 
 class Node:
     # A node that shall encapsulate the data about an intent and peripherals
@@ -21,6 +59,12 @@ class Node:
         self.alias = alias or ""
         self.id = _id
         self.orphan = True
+        self.compiled_matches = None
+        self.compiled_connection_matches = None
+        self.token_frequencies = None
+        self.json_hash = None
+        self.payload_dispatch = None
+        self.routing_order = None
 
 
 class Graph:
@@ -33,6 +77,8 @@ class Graph:
         self.graph_id = company_id
         self.orphans = set()
         self.orphan_list = list()
+        self.orphan_dispatch = None
+        self.orphan_routing_order = None
         self.node_map = dict()
         self.node_id_map = dict()
         self.db_info = dict()
@@ -44,6 +90,9 @@ class Graph:
             for class_string in self.graph_utils["class"]:
                 if type(self.graph_utils["class"][class_string]) is str:
                     self.graph_utils["class"][class_string] = self.graph_utils["class"][class_string].replace('\\\\', '\\')
+        # compile the classes once
+        self.class_engine = utils.ClassEngine(self.graph_utils["class"])
+        self.logic_operations = self.get_logic_operations()
 
     def get_node(self, node_name):
         return self.node_map.get(node_name)
@@ -51,16 +100,20 @@ class Graph:
     def get_node_by_id(self, node_id):
         return self.node_id_map.get(node_id)
 
-    def populate_graph(self, dir_path, db_object, redis_object, extraction_indices):
+    def populate_graph(self, dir_path, db_object, redis_object, extraction_indices, previous_graph=None):
         '''
         Read a stored graph from JSON files under the directory
         Read aux graph info from DB.
         Identify the orphan nodes.
         Set up the 1:1 mapping of a node name/ id with its object
+        If the previous version of the graph is given, nodes whose JSON has not changed reuse its compiled matches
+        and lemmatized searchable text, and its search postings are copied and updated with the searchable nodes that
+        changed instead of being rebuilt.
         :param dir_path:
         :param db_object:
         :param redis_object:
         :param extraction_indices:
+        :param previous_graph:
         :return:
         '''
 
@@ -77,6 +130,14 @@ class Graph:
         # read from DB
         self.db_info = db_object["graphdetails"].find_one({"graph_id": self.graph_id})
 
+        # compiled matches can be reused only if they were compiled under the same utils
+        if previous_graph and previous_graph.graph_utils == self.graph_utils:
+            self.graph_utils = previous_graph.graph_utils
+            self.class_engine = previous_graph.class_engine
+            self.logic_operations = previous_graph.logic_operations
+        else:
+            previous_graph = None
+
         # enumerate on keys
         # there are 2 cases: nodes have keys and nodes don't
         # either cases are exhaustive
@@ -102,6 +163,14 @@ class Graph:
             node_suggested = node_json.get("suggested")
 
             current_node = Node(node_name, node_connections, node_action, node_matches, node_context, node_searchable, node_suggested, node_alias, node_id, node_no_match_before)
+            current_node.json_hash = hashlib.md5(json.dumps(node_json, sort_keys=True)).hexdigest()
+
+            # reuse work done for the node if it has not changed
+            previous_node = previous_graph.get_node(node_name) if previous_graph else None
+            if previous_node and previous_node.json_hash == current_node.json_hash:
+                current_node.compiled_matches = previous_node.compiled_matches
+                current_node.compiled_connection_matches = previous_node.compiled_connection_matches
+                current_node.token_frequencies = previous_node.token_frequencies
 
             # put into mappings
             self.node_map[node_name] = current_node
@@ -110,12 +179,19 @@ class Graph:
         # Enumerate over nodes and build connections
         # Also set the orphan flag for appropriate nodes
 
+        # Compile the matching conditions so that messages do not re-walk the JSON
         # TODO generate auto placeholders based on mapping. Along the same lines as for actions
         for node_name, node in self.node_map.items():
-            for connected_node in node.connections:
+            if node.compiled_matches is None:
+                node.compiled_matches = self.compile_json_logic(node.matches)
+            if node.compiled_connection_matches is None:
+                node.compiled_connection_matches = [self.compile_json_logic(connected_node.get("matches")) for connected_node in node.connections]
+            for connected_node, compiled_matches in zip(node.connections, node.compiled_connection_matches):
                 con_node_name = connected_node["name"]
                 connected_node["node"] = self.node_map.get(con_node_name)
                 connected_node["node"].orphan = False
+                connected_node["compiled_matches"] = compiled_matches
+                connected_node["match_payload"] = self.get_match_payload(connected_node.get("matches"))
 
         # Add orphan nodes to the list
         # and build postings list
@@ -125,25 +201,184 @@ class Graph:
                 self.orphan_list.append({
                     "node": node,
                     "name": node_name,
-                    "matches": node.matches
+                    "matches": node.matches,
+                    "compiled_matches": node.compiled_matches,
+                    "match_payload": self.get_match_payload(node.matches)
                 })
-            self.build_postings(node)
-        # compute tf-idf scores
-        self.search_postings.compute_tf_idf()
+            if not previous_graph:
+                self.build_postings(node)
+        # build payload dispatch tables for quick-reply clicks
+        # and the orders used for top-1 routing
+        self.orphan_dispatch = self.build_payload_dispatch(self.orphan_list)
+        self.orphan_routing_order = self.build_routing_order(self.orphan_list, 1)
+        for node_name, node in self.node_map.items():
+            node.payload_dispatch = self.build_payload_dispatch(node.connections)
+            node.routing_order = self.build_routing_order(node.connections, 0)
+        # compute tf-idf scores, or update the ones of the previous version
+        if previous_graph:
+            self.update_search_postings(previous_graph)
+        else:
+            self.search_postings.compute_tf_idf()
 
         # build/ reuse postings for extraction mappings
         self.build_extraction_postings(db_object, redis_object, extraction_indices)
 
+    def get_match_payload(self, matches):
+        '''
+        returns the payload if the matching conditions are a plain {"==": [{"var": "payload"}, "<payload>"]} (either
+        way round). Otherwise, returns None
+        :param matches:
+        :return:
+        '''
+        if type(matches) != dict or matches.keys() != ["=="]:
+            return None
+        values = matches["=="]
+        if type(values) not in [list, tuple] or len(values) != 2:
+            return None
+        for var, payload in [values, values[::-1]]:
+            if var in [{"var": "payload"}, {"var": ["payload"]}] and isinstance(payload, basestring):
+                return payload
+        return None
+
+    def build_payload_dispatch(self, connections):
+        '''
+        Splits connections into the ones whose match is decided by payload equality and the rest.
+        The former are put in a hash table from payload to their positions in the list. Connections sharing a name
+        with another are always treated as the rest, since their scores overwrite each other.
+        :param connections:
+        :return:
+        '''
+        payload_positions = dict()
+        general_positions = []
+        name_counts = dict()
+        for connection in connections:
+            name_counts[connection["name"]] = name_counts.get(connection["name"], 0) + 1
+        for position, connection in enumerate(connections):
+            payload = self.get_match_payload(connection.get("matches"))
+            if payload is None or name_counts[connection["name"]] > 1:
+                general_positions.append(position)
+            else:
+                payload_positions.setdefault(payload, []).append(position)
+        return {
+            "connections": connections,
+            "num_connections": len(connections),
+            "payload_positions": payload_positions,
+            "general_positions": general_positions
+        }
+
+    def get_candidate_connections(self, node, data=None):
+        '''
+        returns the connections and orphans that need to be evaluated for the node, in the order of evaluation.
+        Connections and orphans decided by payload equality are picked from the dispatch tables, so the ones whose
+        payload does not match are skipped. They would have scored 0.
+        Falls back to every connection and orphan if the node's connections have changed since the graph loaded.
+        :param node:
+        :param data:
+        :return:
+        '''
+        payload = data.get("payload") if data else None
+        connection_dispatch = node.payload_dispatch
+        if not isinstance(payload, basestring) or not connection_dispatch or not self.orphan_dispatch \
+                or connection_dispatch["connections"] is not node.connections \
+                or connection_dispatch["num_connections"] != len(node.connections):
+            return node.connections + self.orphan_list
+
+        # positions of orphans follow the positions of connections
+        offset = connection_dispatch["num_connections"]
+        positions = connection_dispatch["payload_positions"].get(payload, []) + connection_dispatch["general_positions"]
+        positions += [offset + position for position in self.orphan_dispatch["payload_positions"].get(payload, [])]
+        positions += [offset + position for position in self.orphan_dispatch["general_positions"]]
+        return [node.connections[position] if position < offset else self.orphan_list[position - offset]
+                for position in sorted(positions)]
+
+    def is_bounded_logic(self, tests):
+        '''
+        returns True if the test is known to evaluate to a boolean, None or a number not above 100.
+        i.e. nothing it scores can beat a test that evaluates to True.
+        :param tests:
+        :return:
+        '''
+        if tests is None or type(tests) == bool:
+            return True
+        if type(tests) in [int, float]:
+            return tests <= 100
+        if type(tests) != dict:
+            return False
+        op = tests.keys()[0]
+        values = tests[op]
+        if type(values) not in [list, tuple]:
+            values = [values]
+        if op in ["==", "===", "!=", "!==", ">", ">=", "<", "<=", "!", "bool", "in", "fuzzy", "fuzzyMessage", "class",
+                  "extract"]:
+            return True
+        if op in ["and", "or"]:
+            return all(map(self.is_bounded_logic, values))
+        if op == "?:":
+            return all(map(self.is_bounded_logic, values[1:]))
+        return False
+
+    def build_routing_order(self, connections, group):
+        '''
+        Precomputes the order in which top-1 routing evaluates connections: by name, then by position.
+        The group tells connections (0) from orphans (1), as orphans are evaluated after a node's connections.
+        Routing is possible only if the names are unique and no connection can score above 100.
+        :param connections:
+        :param group:
+        :return:
+        '''
+        names = [connection["name"] for connection in connections]
+        return {
+            "connections": connections,
+            "num_connections": len(connections),
+            "order": sorted((connection["name"], group, index) for index, connection in enumerate(connections)),
+            "routable": len(set(names)) == len(names) and all(self.is_bounded_logic(connection.get("matches")) for connection in connections)
+        }
+
     def build_postings(self, node):
+        if node.searchable:
+            # lemmatize only if not done for an earlier version of the node
+            if node.token_frequencies is None:
+                node.token_frequencies = self.get_token_frequencies(node)
+            # put token and frequency info in postings
+            for token in node.token_frequencies:
+                self.search_postings.add_document_for_token(token, node.id, {"tf": node.token_frequencies[token]})
+
+    def update_search_postings(self, previous_graph):
+        '''
+        sets the search postings to a copy of the ones of the previous version of the graph, with the docs of the
+        searchable nodes that were added, changed or removed updated. Docs are keyed by node id.
+        The previous version keeps its own postings, for the turns still using it
+        :param previous_graph:
+        :return:
+        '''
+        self.search_postings = previous_graph.search_postings.copy()
+        previous_frequencies = dict()
+        for node in previous_graph.node_map.values():
+            if node.searchable:
+                previous_frequencies[node.id] = node.token_frequencies
+        for node in self.node_map.values():
+            if node.searchable:
+                if node.token_frequencies is None:
+                    node.token_frequencies = self.get_token_frequencies(node)
+                if previous_frequencies.pop(node.id, None) != node.token_frequencies:
+                    self.search_postings.update_document(node.id, node.token_frequencies)
+        for node_id in previous_frequencies:
+            self.search_postings.remove_document(node_id)
+        self.search_postings.refresh_tf_idf()
+
+    def get_token_frequencies(self, node):
+        '''
+        returns the frequencies of the lemmatized and stemmed tokens of a searchable node
+        :param node:
+        :return:
+        '''
         if node.searchable:
             # extra weight to the question text
             # TODO make this generic. weights should be incorporated in the graph
             # TODO a default weight system should be used in case weights are not put in the graph
             searchable_text= " ".join(node.searchable) + node.searchable[0]*2
-            # get lemmatized tokens
-            lemmatized_tokens = utils.lemmatize_text(searchable_text.lower())
-            # get stemmed tokens
-            stemmed_tokens = utils.stem_text(searchable_text.lower())
+            # get lemmatized and stemmed tokens
+            lemmatized_tokens, stemmed_tokens = utils.normalise_text(searchable_text.lower())
 
             # merge the lemmatized and stemmed tokens into lmmatized_tokens
             # every stemmed token that gets put, is put as many times its versions occur in the text
@@ -159,51 +394,317 @@ class Graph:
             for token in lemmatized_tokens:
                 token_frequency = token_frequencies.get(token, 0)
                 token_frequencies[token] = token_frequency + 1
-            # put token and frequency info in postings
-            for token in token_frequencies:
-                self.search_postings.add_document_for_token(token, node.id, {"tf": token_frequencies[token]})
+            return token_frequencies
 
     def build_extraction_postings(self,db_object, redis_object, extraction_indices):
         if self.db_info and self.db_info.get("mappings"):
             map_names = self.db_info.get("mappings", []) or []
             for map_name in map_names:
+                # built for another graph or an earlier version of this one. Updated if the mapping has changed in
+                # the db since
+                if map_name in extraction_indices:
+                    self.update_extraction_postings(db_object, redis_object, extraction_indices, map_name)
+                    continue
                 # initializations
                 mapping = dict()
                 postings_object = Postings()
                 # skip if entry for the map exists in redis
                 map_value = redis_object.get(map_name)
+                postings_file_path = self.get_postings_file_path(map_name)
+                # reuse postings stored on disk if they were built from the same mapping
+                if map_value:
+                    # mappings stored before they were versioned get a version, so that workers can cache them
+                    redis_object.setnx("version" + map_name, 1)
+                if map_value and postings_file_path:
+                    mapped_postings = self.open_mapped_postings(postings_file_path, map_value)
+                    if mapped_postings:
+                        mapped_postings.phrase_index = self.get_phrase_index(redis_object, map_name)
+                        self.store_mapping_entries(redis_object, map_name, mapped_postings)
+                        extraction_indices[map_name] = mapped_postings
+                        continue
                 # in case the entry has not been populated before
                 if not map_value:
                     # get mapping from DB
                     mapping = db_object["mappings"].find_one({"name": map_name})
                     mapping.pop("_id")
                     # store mapping in Redis
-                    redis_object.set(map_name, json.dumps(mapping))
+                    source_text = json.dumps(mapping)
+                    redis_object.set(map_name, source_text)
                 else:
+                    source_text = map_value
                     mapping = json.loads(map_value)
                 entries = mapping.get("map")
                 tokenized_entries = []
                 fields_to_index = mapping.get("toIndex")
-                # build postings
-                for i, entry in enumerate(entries):
+                tokenized = None
+                if map_value:
+                    # the tokens stored when the mapping was indexed
+                    tokenized = self.get_stored_tokens(redis_object, map_name, len(entries))
+                if tokenized is None:
+                    started_at = time.time()
+                    tokenized = self.tokenize_mapping(entries, fields_to_index)
+                    elapsed = time.time() - started_at
+                    print "indexed %d entries of %s in %.2fs (%.0f entries/s)" % (len(entries), map_name, elapsed, len(entries) / elapsed if elapsed else 0.0)
+                    redis_object.set("postingstokens" + map_name, json.dumps([tokens for tokens, tokenized_elements in tokenized]))
+                # build postings, in the order of the entries
+                for i, (tokens, tokenized_elements) in enumerate(tokenized):
                     # use active entries
-                    if entry.get("active"):
-                        # merge all texts
-                        stripped_text = utils.remove_non_alpha_num_chars(" ".join(filter(lambda x: bool(x), reduce(lambda x,y: x+y, [entry.get(field, []) or [] if type(entry.get(field, []) or []) == list else [str(entry[field])] for field in fields_to_index], []))))[0]
-                        # generate tokens
-                        if stripped_text:
-                            map(lambda x: postings_object.add_document_for_token(x, i), set(utils.lemmatize_text(stripped_text.lower())))
-                        if not map_value:
-                            # construct tokens for all constituents of the entry and store in redis if not already there
-                            tokenized_elements = map(lambda x: sorted(utils.lemmatize_text(utils.remove_non_alpha_num_chars(x)[0])),filter(lambda x: bool(x), reduce(lambda x,y: x+y, [entry.get(field, []) or [] if type(entry.get(field, []) or []) == list else [str(entry[field])] for field in fields_to_index], [])))
-                            tokenized_entries.append(tokenized_elements)
-                    else:
-                        if not map_value:
-                            tokenized_entries.append(None)
-                extraction_indices[map_name] = postings_object
+                    if tokens is not None:
+                        map(lambda x: postings_object.add_document_for_token(x, i), tokens)
+                    # tokens for all constituents of the entry
+                    tokenized_entries.append(tokenized_elements)
+                if postings_file_path:
+                    # store on disk and use the mapped file so that workers share its pages
+                    postings_object.dump(postings_file_path, self.get_source_hash(source_text))
+                    postings_object = MappedPostings(postings_file_path)
                 if not map_value:
                     # set tokenized mappings in redis if not already there
                     redis_object.set("tokenized" + map_name, json.dumps(tokenized_entries))
+                    self.store_mapping_entries(redis_object, map_name, postings_object, mapping, tokenized_entries)
+                    # workers reload their cached copies of the mapping
+                    redis_object.incr("version" + map_name)
+                    postings_object.phrase_index = utils.PhraseIndex(tokenized_entries)
+                else:
+                    postings_object.phrase_index = utils.PhraseIndex(tokenized_entries)
+                    self.store_mapping_entries(redis_object, map_name, postings_object)
+                if not postings_file_path:
+                    postings_object.source_hash = self.get_source_hash(source_text)
+                extraction_indices[map_name] = postings_object
+
+    def update_extraction_postings(self, db_object, redis_object, extraction_indices, map_name):
+        '''
+        updates the postings of a mapping if the mapping has changed in the db since they were built.
+        Only the entries that changed are tokenized again: the tokens of the others are taken from the ones stored in
+        redis for the previous version of the mapping, unless another worker has already stored the new version.
+        Postings in memory are updated in place, with the docs of the entries that changed. Postings on disk are
+        written again, since the file is read-only and shared, and the new file is opened
+        :param db_object:
+        :param redis_object:
+        :param extraction_indices:
+        :param map_name:
+        :return:
+        '''
+        postings_object = extraction_indices[map_name]
+        mapping = db_object["mappings"].find_one({"name": map_name})
+        if not mapping:
+            return
+        mapping.pop("_id")
+        source_text = json.dumps(mapping)
+        source_hash = self.get_source_hash(source_text)
+        if postings_object.source_hash == source_hash:
+            return
+        entries = mapping.get("map")
+        fields_to_index = mapping.get("toIndex")
+        map_value = redis_object.get(map_name)
+        tokenized = None
+        if map_value and self.get_source_hash(map_value) == source_hash:
+            # stored by another worker
+            tokenized = self.get_stored_tokens(redis_object, map_name, len(entries))
+        stored = tokenized is not None
+        if not stored:
+            tokenized = self.tokenize_changed_entries(redis_object, map_name, map_value, entries, fields_to_index)
+        tokenized_entries = [tokenized_elements for tokens, tokenized_elements in tokenized]
+        postings_file_path = self.get_postings_file_path(map_name)
+        if postings_file_path:
+            new_postings = self.open_mapped_postings(postings_file_path, source_text)
+            if not new_postings:
+                new_postings = Postings()
+                for i, (tokens, tokenized_elements) in enumerate(tokenized):
+                    if tokens is not None:
+                        new_postings.add_document(i, dict((token, 0) for token in tokens))
+                new_postings.dump(postings_file_path, source_hash)
+                new_postings = MappedPostings(postings_file_path)
+            # the previous file stays mapped for the graphs that still use it
+            postings_object = new_postings
+        else:
+            doc_tokens = postings_object.get_doc_tokens()
+            for i in [doc_id for doc_id in doc_tokens if doc_id >= len(tokenized)]:
+                postings_object.remove_document(i)
+            for i, (tokens, tokenized_elements) in enumerate(tokenized):
+                if tokens is None:
+                    postings_object.remove_document(i)
+                elif set(tokens) != doc_tokens.get(i, set()):
+                    postings_object.update_document(i, dict((token, 0) for token in tokens))
+            postings_object.source_hash = source_hash
+        postings_object.phrase_index = utils.PhraseIndex(tokenized_entries)
+        if stored:
+            self.store_mapping_entries(redis_object, map_name, postings_object)
+        else:
+            redis_object.set("postingstokens" + map_name, json.dumps([tokens for tokens, tokenized_elements in tokenized]))
+            redis_object.set("tokenized" + map_name, json.dumps(tokenized_entries))
+            self.store_mapping_entries(redis_object, map_name, postings_object, mapping, tokenized_entries)
+            # the tokens are stored before the mapping, which other workers compare with the db
+            redis_object.set(map_name, source_text)
+            # workers reload their cached copies of the mapping
+            redis_object.incr("version" + map_name)
+        extraction_indices[map_name] = postings_object
+        print "updated %s: %d entries" % (map_name, len(entries))
+
+    def tokenize_changed_entries(self, redis_object, map_name, map_value, entries, fields_to_index):
+        '''
+        returns what tokenize_mapping returns for the entries of a new version of a mapping, tokenizing only the
+        entries that differ from the ones at the same index in the previous version, stored in redis as map_value
+        :param redis_object:
+        :param map_name:
+        :param map_value:
+        :param entries:
+        :param fields_to_index:
+        :return:
+        '''
+        previous_entries = []
+        previous_tokenized = None
+        if map_value:
+            previous_mapping = json.loads(map_value)
+            # every entry is tokenized again if the indexed fields changed
+            if previous_mapping.get("toIndex") == fields_to_index:
+                previous_entries = previous_mapping.get("map") or []
+                previous_tokenized = self.get_stored_tokens(redis_object, map_name, len(previous_entries))
+        if previous_tokenized is None:
+            previous_entries = []
+        changed = [i for i, entry in enumerate(entries) if i >= len(previous_entries) or entry != previous_entries[i]]
+        tokenized = previous_tokenized[:len(entries)] if previous_tokenized else []
+        tokenized.extend([None] * (len(entries) - len(tokenized)))
+        started_at = time.time()
+        for i, tokenized_entry in zip(changed, self.tokenize_mapping([entries[i] for i in changed], fields_to_index)):
+            tokenized[i] = tokenized_entry
+        print "indexed %d changed entries of %s in %.2fs" % (len(changed), map_name, time.time() - started_at)
+        return tokenized
+
+    def store_mapping_entries(self, redis_object, map_name, postings_object, mapping=None, tokenized_entries=None):
+        '''
+        if the graph uses the "hash" mapping storage, stores the entries and tokenized entries of a mapping in redis
+        hashes keyed by entry index ("entries" + map name and "tokenizedentries" + map name), and the rest of the
+        mapping as "meta" + map name. Extraction then fetches only the candidate entries.
+        If the mapping is not given, it is read from redis unless its hashes have already been stored.
+        :param redis_object:
+        :param map_name:
+        :param postings_object:
+        :param mapping:
+        :param tokenized_entries:
+        :return:
+        '''
+        if self.graph_utils.get("mapping_storage") != "hash":
+            return
+        if mapping is None:
+            if redis_object.exists("meta" + map_name):
+                postings_object.mapping_storage = "hash"
+                return
+            map_value = redis_object.get(map_name)
+            tokenized_value = redis_object.get("tokenized" + map_name)
+            if not map_value or not tokenized_value:
+                return
+            mapping = json.loads(map_value)
+            tokenized_entries = json.loads(tokenized_value)
+        entries = mapping.get("map", []) or []
+        meta = dict((key, value) for key, value in mapping.iteritems() if key != "map")
+        meta["num_entries"] = len(entries)
+        pipe = redis_object.pipeline()
+        pipe.delete("entries" + map_name, "tokenizedentries" + map_name)
+        # write in chunks to keep the commands small
+        for start in xrange(0, len(entries), 1000):
+            end = min(start + 1000, len(entries))
+            pipe.hmset("entries" + map_name, dict((i, json.dumps(entries[i])) for i in xrange(start, end)))
+            pipe.hmset("tokenizedentries" + map_name, dict((i, json.dumps(tokenized_entries[i])) for i in xrange(start, end)))
+        pipe.set("meta" + map_name, json.dumps(meta))
+        pipe.execute()
+        postings_object.mapping_storage = "hash"
+
+    def get_stored_tokens(self, redis_object, map_name, num_entries):
+        '''
+        returns the postings tokens and the tokenized elements of every entry of a mapping, like tokenize_mapping,
+        from the ones stored in redis ("postingstokens" + map name and "tokenized" + map name).
+        None if they are not both stored for all the entries
+        :param redis_object:
+        :param map_name:
+        :param num_entries:
+        :return:
+        '''
+        tokens_value, tokenized_value = redis_object.mget("postingstokens" + map_name, "tokenized" + map_name)
+        if not tokens_value or not tokenized_value:
+            return None
+        postings_tokens = json.loads(tokens_value)
+        tokenized_entries = json.loads(tokenized_value)
+        if len(postings_tokens) != num_entries or len(tokenized_entries) != num_entries:
+            return None
+        return zip(postings_tokens, tokenized_entries)
+
+    def tokenize_mapping(self, entries, fields_to_index):
+        '''
+        tokenizes the entries of a mapping in chunks, in a pool of "indexing_processes" processes if there are
+        more. Returns what tokenize_mapping_entries returns, for all the entries in order
+        :param entries:
+        :param fields_to_index:
+        :return:
+        '''
+        chunk_size = self.graph_utils.get("indexing_chunk_size") or 5000
+        chunks = [(entries[start:start + chunk_size], fields_to_index) for start in xrange(0, len(entries), chunk_size)]
+        num_processes = min(self.graph_utils.get("indexing_processes") or 1, len(chunks))
+        # daemonic processes, such as celery's pool workers, cannot have children
+        if num_processes > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(num_processes)
+            try:
+                # results are in the order of the chunks
+                tokenized_chunks = pool.map(tokenize_mapping_entries, chunks)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            tokenized_chunks = map(tokenize_mapping_entries, chunks)
+        return [tokenized for tokenized_chunk in tokenized_chunks for tokenized in tokenized_chunk]
+
+    def get_phrase_index(self, redis_object, map_name):
+        '''
+        returns the phrase index of the tokenized mapping stored in redis, or None if there is no tokenized mapping
+        :param redis_object:
+        :param map_name:
+        :return:
+        '''
+        tokenized_entries = redis_object.get("tokenized" + map_name)
+        if not tokenized_entries:
+            return None
+        return utils.PhraseIndex(json.loads(tokenized_entries))
+
+    def get_postings_file_path(self, map_name):
+        '''
+        returns the path of the on-disk postings of a mapping, or None if postings are not to be stored on disk
+        :param map_name:
+        :return:
+        '''
+        postings_dir = self.graph_utils.get("postings_dir")
+        if not postings_dir:
+            return None
+        return os.path.join(os.path.realpath(postings_dir), map_name + ".postings")
+
+    def get_source_hash(self, source_text):
+        if type(source_text) == unicode:
+            source_text = source_text.encode("utf-8")
+        return hashlib.md5(source_text).digest()
+
+    def open_mapped_postings(self, postings_file_path, source_text):
+        '''
+        opens the on-disk postings if they exist and were built from source_text. Otherwise, returns None
+        :param postings_file_path:
+        :param source_text:
+        :return:
+        '''
+        if not os.path.exists(postings_file_path):
+            return None
+        try:
+            mapped_postings = MappedPostings(postings_file_path)
+        except (ValueError, EnvironmentError):
+            return None
+        if mapped_postings.source_hash != self.get_source_hash(source_text):
+            mapped_postings.close()
+            return None
+        return mapped_postings
+
+    def get_weight(self):
+        '''
+        returns a rough measure of the memory held by the graph: its nodes and search postings.
+        Extraction postings are shared between graphs and are not counted.
+        :return:
+        '''
+        return len(self.node_map) + sum(token_obj.get_doc_count() for token_obj in self.search_postings.collection.values())
 
     def dump_graph(self):
         '''
@@ -268,6 +769,7 @@ class Graph:
                     # put a copy so that it can be stored in the context
                     connections_to_be_stored.append(json.loads(json.dumps(suggestion_json)))
                     suggestion_json["node"] = suggested_node
+                    suggestion_json["compiled_matches"] = self.compile_json_logic(suggestion_json["matches"])
                     quick_replies.append({
                         "content_type": "text",
                         "title": suggested_node.suggested_response[0].get("text", ""),
@@ -295,13 +797,21 @@ class Graph:
             node = self.node_map[node_name]
         resulting_nodes_with_consequences = dict()
 
+        # stop at the first certain winner if possible
+        if self.graph_utils.get("routing_mode") == "top1":
+            resulting_nodes_with_consequences = self.get_top_child_confidence(node, data)
+            if resulting_nodes_with_consequences is not None:
+                return resulting_nodes_with_consequences
+            resulting_nodes_with_consequences = dict()
+
         # iterate through the current node's connections and orphan nodes and evaluate their possibility of being the
         # next node
         found = False
-        for connection in node.connections + self.orphan_list:
+        for connection in self.get_candidate_connections(node, data):
             if not connection["node"].no_match_before or (not found and connection["node"].no_match_before):
-                matching_conditions = connection["matches"]
-                result = self.json_logic(matching_conditions, data)
+                # connections restored from the context are not compiled
+                compiled_matches = connection.get("compiled_matches") or self.compile_json_logic(connection["matches"])
+                result = compiled_matches(data)
                 if result is True:
                     result = 100
                     found = True
@@ -311,76 +821,346 @@ class Graph:
 
         return resulting_nodes_with_consequences
 
-    def json_logic(self, tests, data=None):
+    def get_top_child_confidence(self, node, data=None):
         '''
-        Evaluate JSON Logic. The matching conditions for a node and its connections are stored in JSON
-        format. This evaluator takes in relevant data and evaluates a test against the data. The boolean o/p
-        is returned
-        :param tests:
+        Top-1 routing. Evaluates the node's connections and the orphans in the tiebreak order of
+        get_highest_probability_intent (score descending, then name) and stops at the first one that scores 100, as
+        nothing after it can beat it. Falls back to scoring all of them if none does, i.e. only fractional scores.
+        A no_match_before connection that scores 100 wins only if nothing before it, in the usual order, matched.
+        The result leads get_highest_probability_intent to the same intent as get_child_confidence would. Though,
+        since evaluation order changes, side effects of tests (e.g. extract) may differ. Hence, opt-in.
+        returns None if the node cannot be routed this way
+        :param node:
         :param data:
         :return:
         '''
-        # You've recursed to a primitive, stop!
-        if tests is None or type(tests) != dict:
-            return tests
+        routing_order = node.routing_order
+        if not routing_order or not self.orphan_routing_order or not routing_order["routable"] \
+                or not self.orphan_routing_order["routable"] \
+                or routing_order["connections"] is not node.connections \
+                or routing_order["num_connections"] != len(node.connections):
+            return None
+
+        payload = data.get("payload") if data else None
+        groups = [node.connections, self.orphan_list]
+        results = dict()
+        disqualified = set()
+
+        def evaluate(group, index):
+            if (group, index) not in results:
+                connection = groups[group][index]
+                match_payload = connection.get("match_payload")
+                # a plain payload comparison need not be evaluated
+                if match_payload is not None and isinstance(payload, basestring) and match_payload != payload:
+                    results[(group, index)] = False
+                else:
+                    results[(group, index)] = connection["compiled_matches"](data)
+            return results[(group, index)]
+
+        def found_before(group, index):
+            earlier = [(0, i) for i in xrange(len(node.connections) if group else index)]
+            earlier += [(1, j) for j in xrange(index if group else 0)]
+            return any(evaluate(*position) is True for position in earlier)
+
+        for name, group, index in heapq.merge(routing_order["order"], self.orphan_routing_order["order"]):
+            result = evaluate(group, index)
+            if result is True or result == 100:
+                if groups[group][index]["node"].no_match_before and found_before(group, index):
+                    disqualified.add((group, index))
+                    continue
+                break
 
-        data = data or {}
+        resulting_nodes_with_consequences = dict()
+        for position, result in results.items():
+            if position not in disqualified:
+                if result is True:
+                    result = 100
+                elif result in [False, None]:
+                    result = 0
+                resulting_nodes_with_consequences[groups[position[0]][position[1]]["name"]] = result
+        return resulting_nodes_with_consequences
 
+    def get_logic_operations(self):
+        '''
+        Returns the operations supported by JSON Logic. Every operation takes the data being evaluated as its first
+        argument, followed by the evaluated values of the test.
+        Built once per graph so that evaluating a test does not rebuild the table.
+        The operations do not refer to the graph itself, so compiled tests can outlive it on a reload.
+        :return:
+        '''
+        graph_utils = self.graph_utils
+        class_engine = self.class_engine
+        return {
+            "==": (lambda data, a, b: a == b),
+            "===": (lambda data, a, b: a is b),
+            "!=": (lambda data, a, b: a != b),
+            "!==": (lambda data, a, b: a is not b),
+            ">": (lambda data, a, b: a > b),
+            ">=": (lambda data, a, b: a >= b),
+            "<": (lambda data, a, b, c=None: a < b if (c is None) else (a < b) and (b < c)),
+            "<=": (lambda data, a, b, c=None: a <= b if (c is None) else (a <= b) and (b <= c)),
+            "!": (lambda data, a: not a),
+            "%": (lambda data, a, b: a % b),
+            "and": (lambda data, *args: reduce(lambda total, arg: total and arg, args, True)),
+            "or": (lambda data, *args: reduce(lambda total, arg: total or arg, args, False)),
+            "?:": (lambda data, a, b, c: b if a else c),
+            "log": (lambda data, a: a if sys.stdout.write(str(a)) else a),
+            "in": (lambda data, a, b: a in b if "__contains__" in dir(b) else False),
+            "var": (lambda data, a, not_found=None: utils.get_value_from_keys(data, str(a).split("."), not_found)),
+            "cat": (lambda data, *args: "".join(args)),
+            "+": (lambda data, *args: reduce(lambda total, arg: total + float(arg), args, 0.0)),
+            "*": (lambda data, *args: reduce(lambda total, arg: total * float(arg), args, 1.0)),
+            "-": (lambda data, a, b=None: -a if b is None else a - b),
+            "/": (lambda data, a, b=None: a if b is None else float(a) / float(b)),
+            "min": (lambda data, *args: min(args)),
+            "max": (lambda data, *args: max(args)),
+            "function": (lambda data, *args: intents.execute_function(args[0], args[1], data.get('context', None))),
+            "regex": (lambda data, x, y: re.match(x, y)),
+            "fuzzy": (lambda data, x, y: utils.fuzzy_text_matcher(x, y)),
+            "fuzzyMessage": (lambda data, x: utils.fuzzy_text_matcher(data.get('message', ""), x) > graph_utils["min_fuzzy_prob"]),
+            "class": (lambda data, x: class_engine.class_check(data, x)),
+            "bool": (lambda data, a: bool(a)),
+            "extract": (lambda data, *x: utils.perform_extraction(x, data)),
+            "count": (lambda data, *x: utils.length(x))
+        }
+
+    def get_logic_cost(self, tests):
+        '''
+        Estimates the cost of evaluating a test. Used to order the values of "and" and "or" so that cheap ones
+        (var, == on payload) are evaluated before expensive ones (fuzzy, extract, function).
+        NOTE "and"/"or" return one of their values, so ordering can change a fractional score. Hence, optional.
+        :param tests:
+        :return:
+        '''
+        if tests is None or type(tests) != dict:
+            return 0
         op = tests.keys()[0]
         values = tests[op]
-        operations = {
-            "==": (lambda a, b: a == b),
-            "===": (lambda a, b: a is b),
-            "!=": (lambda a, b: a != b),
-            "!==": (lambda a, b: a is not b),
-            ">": (lambda a, b: a > b),
-            ">=": (lambda a, b: a >= b),
-            "<": (lambda a, b, c=None: a < b if (c is None) else (a < b) and (b < c)),
-            "<=": (lambda a, b, c=None: a <= b if (c is None) else (a <= b) and (b <= c)),
-            "!": (lambda a: not a),
-            "%": (lambda a, b: a % b),
-            "and": (lambda *args: reduce(lambda total, arg: total and arg, args, True)),
-            "or": (lambda *args: reduce(lambda total, arg: total or arg, args, False)),
-            "?:": (lambda a, b, c: b if a else c),
-            "log": (lambda a: a if sys.stdout.write(str(a)) else a),
-            "in": (lambda a, b: a in b if "__contains__" in dir(b) else False),
-            "var": (lambda a, not_found=None:
-                    reduce(lambda data, key: (data.get(key, not_found)
-                                              if type(data) == dict
-                                              else data[int(key)]
-                    if type(data) in [list, tuple]
-                    else not_found),
-                           str(a).split("."),
-                           data)),
-            "cat": (lambda *args: "".join(args)),
-            "+": (lambda *args: reduce(lambda total, arg: total + float(arg), args, 0.0)),
-            "*": (lambda *args: reduce(lambda total, arg: total * float(arg), args, 1.0)),
-            "-": (lambda a, b=None: -a if b is None else a - b),
-            "/": (lambda a, b=None: a if b is None else float(a) / float(b)),
-            "min": (lambda *args: min(args)),
-            "max": (lambda *args: max(args)),
-            "function": (lambda *args: intents.execute_function(args[0], args[1], data.get('context', None))),
-            "regex": (lambda x, y: re.match(x, y)),
-            "fuzzy": (lambda x, y: utils.fuzzy_text_matcher(x, y)),
-            "fuzzyMessage": (lambda x: utils.fuzzy_text_matcher(data.get('message', ""), x) > self.graph_utils["min_fuzzy_prob"]),
-            "class": (lambda x: utils.class_check(data.get("message", ""), x, self.graph_utils)),
-            "bool": (lambda a: bool(a)),
-            "extract": (lambda *x: utils.perform_extraction(x, data)),
-            "count": (lambda *x: utils.length(x))
+        if type(values) not in [list, tuple]:
+            values = [values]
+        op_costs = {
+            "class": 1,
+            "in": 1,
+            "regex": 2,
+            "fuzzy": 5,
+            "fuzzyMessage": 5,
+            "function": 10,
+            "extract": 10
         }
+        return op_costs.get(op, 0) + sum(map(self.get_logic_cost, values))
 
-        if op not in operations:
-            raise RuntimeError("Unrecognized operation %s" % op)
+    def compile_json_logic(self, tests):
+        '''
+        Compile JSON Logic into a callable that takes in relevant data and returns what json_logic would return for
+        the same test. The operation lookup and the splitting of constant "var" paths are resolved here, once, so
+        that evaluating a test per message only calls closures.
+        :param tests:
+        :return:
+        '''
+        # You've recursed to a primitive, stop!
+        if tests is None or type(tests) != dict:
+            return lambda data=None: tests
+
+        op = tests.keys()[0]
+        values = tests[op]
+
+        if op not in self.logic_operations:
+            # keep the error at evaluation time, as json_logic does
+            def unrecognized_operation(data=None):
+                raise RuntimeError("Unrecognized operation %s" % op)
+            return unrecognized_operation
 
         # Easy syntax for unary operators, like {"var": "x"} instead of strict
         # {"var": ["x"]}
         if type(values) not in [list, tuple]:
             values = [values]
 
-        # Recursion!
+        # constant paths are split ahead of time
+        if op == "var" and len(values) in [1, 2] and not any(type(val) == dict for val in values):
+            keys = str(values[0]).split(".")
+            not_found = values[1] if len(values) == 2 else None
+            return lambda data=None: utils.get_value_from_keys(data or {}, keys, not_found)
+
+        # optionally, evaluate cheap values before expensive ones
+        if op in ["and", "or"] and self.graph_utils.get("reorder_logic"):
+            values = sorted(values, key=self.get_logic_cost)
+
+        operation = self.logic_operations[op]
+        compiled_values = [self.compile_json_logic(val) for val in values]
+
+        # Short-circuit: evaluate values only as far as the operation needs them
+        if op in utils.short_circuit_operations:
+            short_circuit_operation = utils.short_circuit_operations[op]
+
+            def evaluate_lazily(data=None):
+                data = data or {}
+                try:
+                    return short_circuit_operation(lambda compiled_value: compiled_value(data), compiled_values)
+                except RuntimeError:
+                    return operation(data, *values)
+
+            return evaluate_lazily
+
+        def evaluate(data=None):
+            data = data or {}
+            # Recursion!
+            try:
+                evaluated_values = [compiled_value(data) for compiled_value in compiled_values]
+            except RuntimeError:
+                evaluated_values = values
+            return operation(data, *evaluated_values)
+
+        return evaluate
+
+    def json_logic(self, tests, data=None):
+        '''
+        Evaluate JSON Logic. The matching conditions for a node and its connections are stored in JSON
+        format. This evaluator takes in relevant data and evaluates a test against the data. The boolean o/p
+        is returned
+        Prefer compile_json_logic for tests that are evaluated repeatedly.
+        :param tests:
+        :param data:
+        :return:
+        '''
+        return self.compile_json_logic(tests)(data)
+
+
+class GraphRegistry:
+    # Loads the graph of a company the first time it is asked for, instead of loading every graph upfront.
+    # Keeps the loaded graphs in an LRU bounded by their number and, optionally, by their total weight
+    # (see Graph.get_weight)
+    # Reloads a graph when its files change, checking at most every reload_interval seconds. The new version is
+    # built next to the old one and swapped in, so turns that already have the old one finish against it.
+
+    def __init__(self, graphs_path, db_object, redis_object, extraction_indices, max_graphs=0, max_weight=0, reload_interval=0):
+        self.graphs_path = graphs_path
+        self.db_object = db_object
+        self.redis_object = redis_object
+        self.extraction_indices = extraction_indices
+        self.max_graphs = max_graphs
+        self.max_weight = max_weight
+        self.reload_interval = reload_interval
+        self.graphs = OrderedDict()
+        self.weights = dict()
+        self.signatures = dict()
+        self.checked_at = dict()
+        self.lock = threading.Lock()
+
+    def get_graph(self, company_id):
+        '''
+        returns the graph for a company, loading or reloading it if needed. returns None if the company has no graph
+        :param company_id:
+        :return:
+        '''
+        with self.lock:
+            chat_graph = self.graphs.pop(company_id, None)
+            if chat_graph is not None and self.reload_interval and time.time() - self.checked_at[company_id] >= self.reload_interval:
+                chat_graph = self.reload_if_changed(company_id, chat_graph)
+            if chat_graph is None:
+                chat_graph = self.load_graph(company_id)
+                if chat_graph is None:
+                    return None
+            # most recently used go last
+            self.graphs[company_id] = chat_graph
+            self.evict(keep=company_id)
+            return chat_graph
+
+    def get_dir_path(self, company_id):
+        '''
+        returns the directory of the graph of a company, or None if the company id is not the name of a directory
+        directly under graphs_path. Company ids come from messages, so they must not lead to other paths
+        :param company_id:
+        :return:
+        '''
+        if not company_id or os.path.basename(company_id) != company_id or company_id in (".", "..") or "\0" in company_id:
+            return None
+        return os.path.realpath(self.graphs_path + "/" + company_id)
+
+    def get_signature(self, company_id):
+        '''
+        returns the names, sizes and modification times of the files of a graph. None if the graph does not exist
+        :param company_id:
+        :return:
+        '''
+        dir_path = self.get_dir_path(company_id)
+        if dir_path is None or not os.path.isdir(dir_path):
+            return None
+        signature = []
+        for file_path in sorted(os.listdir(dir_path)):
+            file_stat = os.stat(dir_path + "/" + file_path)
+            signature.append((file_path, file_stat.st_size, file_stat.st_mtime))
+        return signature
+
+    def load_graph(self, company_id, previous_graph=None):
+        signature = self.get_signature(company_id)
+        if signature is None:
+            return None
+        chat_graph = Graph(company_id)
+        chat_graph.populate_graph(self.get_dir_path(company_id), self.db_object, self.redis_object, self.extraction_indices, previous_graph)
+        self.weights[company_id] = chat_graph.get_weight()
+        self.signatures[company_id] = signature
+        self.checked_at[company_id] = time.time()
+        return chat_graph
+
+    def reload_if_changed(self, company_id, chat_graph):
+        '''
+        reloads the graph if its files have changed, reusing the unchanged nodes of the current version.
+        Keeps the current version if the new one fails to load. returns None if the graph no longer exists.
+        :param company_id:
+        :param chat_graph:
+        :return:
+        '''
+        self.checked_at[company_id] = time.time()
+        signature = self.get_signature(company_id)
+        if signature is None:
+            self.weights.pop(company_id, None)
+            return None
+        if signature == self.signatures.get(company_id):
+            return chat_graph
         try:
-            values = map(lambda val: self.json_logic(val, data), values)
-        except RuntimeError:
-            pass
+            return self.load_graph(company_id, previous_graph=chat_graph)
+        except Exception:
+            print "failed to reload graph " + company_id
+            traceback.print_exc(file=sys.stdout)
+            # do not retry until the files change again
+            self.signatures[company_id] = signature
+            return chat_graph
 
-        return operations[op](*values)
+    def reload_graph(self, company_id):
+        '''
+        reloads the graph of a company now, if it is loaded and its files have changed
+        :param company_id:
+        :return:
+        '''
+        with self.lock:
+            chat_graph = self.graphs.get(company_id)
+            if chat_graph is not None:
+                chat_graph = self.reload_if_changed(company_id, chat_graph)
+                if chat_graph is None:
+                    self.graphs.pop(company_id)
+                else:
+                    self.graphs[company_id] = chat_graph
+
+    def evict(self, keep=None):
+        '''
+        evicts the least recently used graphs while over the bounds. A bound of 0 means no bound.
+        :param keep: company id that shall not be evicted
+        :return:
+        '''
+        for company_id in list(self.graphs):
+            over_count = self.max_graphs and len(self.graphs) > self.max_graphs
+            over_weight = self.max_weight and sum(self.weights.values()) > self.max_weight
+            if not over_count and not over_weight:
+                break
+            if company_id != keep:
+                self.graphs.pop(company_id)
+                self.weights.pop(company_id)
+
+    def prewarm(self, company_ids):
+        '''
+        loads the graphs of the given companies, e.g. the ones with the most traffic
+        :param company_ids:
+        :return:
+        '''
+        for company_id in company_ids:
+            self.get_graph(company_id)
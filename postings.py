@@ -1,15 +1,118 @@
+import os
+import sys
 import math
+import heapq
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, insort
+import numpy
 import utils
 
-class PostingsNode:
+# On-disk postings format. All numbers are little-endian.
+# header: magic, version, number of tokens (T), number of postings (P), total docs, hash of the source
+# then, flat arrays: vocabulary offsets (T+1 int64), postings offsets (T+1 int64), idf (T double),
+# doc ids (P int64), tf (P double), tf-idf (P double), and the utf-8 vocabulary, sorted, as one blob
+POSTINGS_FILE_MAGIC = "MEXP"
+POSTINGS_FILE_VERSION = 1
+POSTINGS_FILE_HEADER = struct.Struct("<4sIIQi16s")
+# elements written at a time
+POSTINGS_FILE_CHUNK = 65536
+
+
+def write_array(data_file, type_code, values):
+    '''
+    writes a flat array of the on-disk format, a chunk at a time so that no more than a chunk is ever copied
+    :param data_file:
+    :param type_code: struct type code of the elements, "q" or "d"
+    :param values: an array, or a list
+    :return:
+    '''
+    for start in xrange(0, len(values), POSTINGS_FILE_CHUNK):
+        chunk = values[start:start + POSTINGS_FILE_CHUNK]
+        # arrays of 8-byte elements are written as they are in memory
+        if type(chunk) == array and chunk.itemsize == 8:
+            if sys.byteorder == "big":
+                chunk.byteswap()
+            data_file.write(chunk.tostring())
+        else:
+            data_file.write(struct.pack("<%d%s" % (len(chunk), type_code), *chunk))
+
+class PostingsNode(object):
+    # The docs of a token are stored in parallel columns: doc_ids[i] has the frequency tfs[i] and the tf-idf
+    # tf_idfs[i]. Integer doc ids are kept in an array; the first id of another type turns it into a list.
+    __slots__ = ("token", "features", "doc_ids", "tfs", "tf_idfs", "impact_doc_ids", "impacts", "doc_id_array")
+
     def __init__(self, token):
         self.token = token
         self.features = {}
-        self.doc_list = []
-        self.doc_id_set = set()
+        self.doc_ids = array('l')
+        self.tfs = array('d')
+        self.tf_idfs = array('d')
+        # impact ordered doc list: docs by their tf-idf divided by the doc's norm, highest first
+        self.impact_doc_ids = []
+        self.impacts = array('d')
+        # doc ids as an int64 array, built when first needed
+        self.doc_id_array = None
+
+    def add_document(self, doc_id, tf):
+        try:
+            self.doc_ids.append(doc_id)
+        except (TypeError, OverflowError):
+            self.doc_ids = list(self.doc_ids)
+            self.doc_ids.append(doc_id)
+        self.tfs.append(tf)
+        self.tf_idfs.append(0.0)
+
+    def remove_document(self, doc_id):
+        '''
+        removes every posting of a document. Returns the number removed
+        :param doc_id:
+        :return:
+        '''
+        removed = 0
+        while doc_id in self.doc_ids:
+            position = self.doc_ids.index(doc_id)
+            del self.doc_ids[position]
+            del self.tfs[position]
+            del self.tf_idfs[position]
+            removed += 1
+        if removed:
+            self.doc_id_array = None
+        return removed
+
+    def get_doc_count(self):
+        return len(self.doc_ids)
+
+    @property
+    def doc_list(self):
+        return [{"id": doc_id, "features": {"tf": tf, "tf-idf": tf_idf}}
+                for doc_id, tf, tf_idf in zip(self.doc_ids, self.tfs, self.tf_idfs)]
 
     def get_doc_id_set(self):
-        return set(map(lambda x: x["id"], self.doc_list))
+        return set(self.doc_ids)
+
+    def get_doc_id_array(self):
+        '''
+        returns the ids of the docs as an int64 numpy array. Only for integer doc ids
+        :return:
+        '''
+        # docs added since the array was built change the count. Removing docs drops the array
+        if self.doc_id_array is None or len(self.doc_id_array) != len(self.doc_ids):
+            self.doc_id_array = numpy.fromiter(self.doc_ids, dtype=numpy.int64, count=len(self.doc_ids))
+        return self.doc_id_array
+
+    def copy(self):
+        node = PostingsNode(self.token)
+        node.features = dict(self.features)
+        node.doc_ids = self.doc_ids[:]
+        node.tfs = self.tfs[:]
+        node.tf_idfs = self.tf_idfs[:]
+        # replaced rather than changed, so they can be shared
+        node.impact_doc_ids = self.impact_doc_ids
+        node.impacts = self.impacts
+        node.doc_id_array = self.doc_id_array
+        return node
 
 
 class Postings:
@@ -19,11 +122,117 @@ class Postings:
         self.vocabulary = []
         self.mapped_vocabulary = {}
         self.docs = []
-        self.doc_term_tf_idf = {}
+        # every token gets a term id when it is added, which it keeps until it is removed
+        self.term_ids = {}
+        self.next_term_id = 0
+        # sparse doc-term tf-idf matrix, a row per document: doc id -> (term ids, ascending, and their tf-idf)
+        self.doc_vectors = {}
+        # doc id -> norm of its row
+        self.doc_norms = {}
+        # once tf-idf has been computed, changes to the docs make it stale. It is then updated when next needed, for
+        # the changed tokens and docs only
+        self.tf_idf_computed = False
+        self.tf_idf_stale = False
+        self.changed_tokens = set()
+        self.changed_docs = set()
+        self.removed_term_ids = set()
+        # tokens whose impact ordered doc lists are out of date. They are rebuilt when a query walks them
+        self.stale_impact_tokens = set()
+        # the number of docs and the doc count of every token when tf-idf was last updated, and the tokens by doc count
+        self.tf_idf_num_docs = -1
+        self.tf_idf_doc_counts = {}
+        self.df_tokens = {}
+        # doc id -> its tokens. Built on the first removal or tf-idf computation and kept up to date from then on
+        self.doc_tokens = None
+        # utils.PhraseIndex of the mapping the postings were built from, if they index one
+        self.phrase_index = None
+        # how that mapping is stored in redis: "json" or "hash"
+        self.mapping_storage = "json"
+        # hash of that mapping
+        self.source_hash = None
 
     def get_token(self, token, default_value=None):
         return self.collection.get(token, default_value)
 
+    def invalidate(self):
+        '''
+        drops everything derived from the docs, after they change. It is rebuilt when next needed
+        :return:
+        '''
+        self.docs = []
+        self.total_docs = -1
+        self.vocabulary = []
+        self.mapped_vocabulary = {}
+
+    def mark_changed(self, token, doc_id):
+        # the tf-idf of the token and the row of the doc are updated when next needed
+        if self.tf_idf_computed:
+            self.changed_tokens.add(token)
+            self.changed_docs.add(doc_id)
+            self.tf_idf_stale = True
+
+    def refresh_tf_idf(self):
+        '''
+        updates tf-idf if the docs changed since it was computed
+        :return:
+        '''
+        if self.tf_idf_stale:
+            self.update_tf_idf(self.changed_tokens, self.changed_docs)
+
+    def get_doc_tokens(self):
+        '''
+        returns a dict of doc id to the tokens that have the doc
+        :return:
+        '''
+        if self.doc_tokens is None:
+            self.doc_tokens = dict()
+            for token, token_obj in self.collection.iteritems():
+                for doc_id in token_obj.doc_ids:
+                    self.doc_tokens.setdefault(doc_id, set()).add(token)
+        return self.doc_tokens
+
+    def add_document(self, doc_id, token_frequencies):
+        '''
+        adds a document with the frequencies of its tokens
+        :param doc_id:
+        :param token_frequencies: dict of token to its frequency in the document
+        :return:
+        '''
+        for token, frequency in token_frequencies.iteritems():
+            self.add_document_for_token(token, doc_id, {"tf": frequency})
+
+    def remove_document(self, doc_id):
+        '''
+        removes a document from all of its tokens. Tokens left without documents are removed.
+        Returns True if the document was there
+        :param doc_id:
+        :return:
+        '''
+        tokens = self.get_doc_tokens().pop(doc_id, set())
+        for token in tokens:
+            token_obj = self.get_token(token)
+            token_obj.remove_document(doc_id)
+            if not token_obj.get_doc_count():
+                self.remove_token(token)
+            self.mark_changed(token, doc_id)
+        if tokens:
+            # the doc list is kept sorted, if it has been built
+            if self.docs:
+                del self.docs[bisect_left(self.docs, doc_id)]
+            if self.total_docs != -1:
+                self.total_docs = len(self.docs) if self.docs else -1
+        return bool(tokens)
+
+    def update_document(self, doc_id, token_frequencies):
+        '''
+        replaces the tokens of a document
+        :param doc_id:
+        :param token_frequencies: dict of token to its frequency in the document
+        :return:
+        '''
+        self.remove_document(doc_id)
+        self.add_document(doc_id, token_frequencies)
+
     def add_token(self, token, return_postings=False):
         '''
         add a token object to the postings
@@ -32,9 +241,23 @@ class Postings:
         :return:
         '''
         self.collection[token] = PostingsNode(token=token)
+        self.term_ids[token] = self.next_term_id
+        self.next_term_id += 1
+        # the vocabulary is kept sorted, if it has been built. Its indices move
+        if self.vocabulary:
+            insort(self.vocabulary, token)
+        self.mapped_vocabulary = {}
         if return_postings:
             return self.collection[token]
 
+    def remove_token(self, token):
+        del self.collection[token]
+        self.removed_term_ids.add(self.term_ids.pop(token))
+        self.stale_impact_tokens.discard(token)
+        if self.vocabulary:
+            del self.vocabulary[bisect_left(self.vocabulary, token)]
+        self.mapped_vocabulary = {}
+
     def get_doc_list(self):
         '''
         return a sorted list of documents (ids)
@@ -43,11 +266,18 @@ class Postings:
         '''
         doc_set = set()
         if len(self.docs) == 0:
-            for token in self.collection:
-                doc_set = doc_set.union(set(map(lambda x: x["id"], self.collection[token].doc_list)))
-            self.docs = sorted(list(doc_set))
+            if self.doc_tokens is not None:
+                self.docs = sorted(self.doc_tokens)
+            else:
+                for token in self.collection:
+                    doc_set.update(self.collection[token].doc_ids)
+                self.docs = sorted(list(doc_set))
         return self.docs
 
+    def get_doc_rank(self, doc_id):
+        # position of the doc in the sorted doc list. Ties in scores go to the earlier doc
+        return bisect_left(self.get_doc_list(), doc_id)
+
     def get_num_docs(self):
         '''
         Returns the number of docs, at the time of calling, after setting a non-negative integer as the value of total_docs
@@ -79,7 +309,8 @@ class Postings:
 
     def add_document_for_token(self, token, doc_id, doc_features=dict()):
         '''
-        adds a document and its features to a token object. It creates a token object if not there
+        adds a document and its features to a token object. It creates a token object if not there.
+        The only feature kept is the frequency, "tf", which is 0 if not given
         :param token:
         :param doc_id:
         :param doc_features:
@@ -90,44 +321,440 @@ class Postings:
         if not node:
             self.add_token(token)
             node = self.get_token(token)
-        node.doc_list.append({
-            "id": doc_id,
-            "features": doc_features
-        })
+        node.add_document(doc_id, doc_features.get("tf", 0))
+        if self.doc_tokens is None:
+            self.invalidate()
+            return
+        # keep the doc list up to date instead of rebuilding it
+        if doc_id not in self.doc_tokens:
+            self.doc_tokens[doc_id] = set()
+            if self.docs:
+                insort(self.docs, doc_id)
+            if self.total_docs != -1:
+                self.total_docs += 1
+        self.doc_tokens[doc_id].add(token)
+        self.mark_changed(token, doc_id)
+
+    def get_idf(self, token, doc_count, num_docs):
+        idf = math.log(num_docs/doc_count)
+        # reduce idf if the token is a stop word
+        if utils.is_stop_word(token):
+            idf /= 2                        # modify this based on experiments
+        return idf
 
     def compute_tf_idf(self):
         '''
         Computes idf for all the tokens in the postings and stores as their features.
         also computes tf-idf for all token-doc pairs.
-        Also populates doc-term adjascency using tf-idf
+        Also populates the sparse doc-term matrix using tf-idf and the norm of every document
         NEEDS the total number of docs. Call this function only after the postings has been populated in a
         basic way
         :return:
         '''
+        self.tf_idf_computed = True
+        self.doc_vectors = {}
+        self.doc_norms = {}
+        self.tf_idf_num_docs = -1
+        self.tf_idf_doc_counts = {}
+        self.df_tokens = {}
+        self.removed_term_ids = set()
+        self.update_tf_idf(set(self.collection), set(self.get_doc_tokens()))
+        for token_obj in self.collection.itervalues():
+            self.build_impacts(token_obj)
+        self.stale_impact_tokens = set()
+
+    def update_tf_idf(self, changed_tokens, changed_docs):
+        '''
+        updates tf-idf after the given tokens and docs changed. Gives the same values as computing it from scratch.
+        The idf of a token only depends on its doc count and the number of docs, so the tokens whose idf changes are
+        the changed ones and the ones whose doc count gives another idf with the new number of docs. Only their tf-idf
+        and the rows and norms of their docs are updated. The impact lists of the tokens of those docs are marked
+        to be rebuilt
+        :param changed_tokens:
+        :param changed_docs:
+        :return:
+        '''
+        self.tf_idf_stale = False
+        self.changed_tokens = set()
+        self.changed_docs = set()
+        num_docs = self.get_num_docs()
         # handling erroneous case
-        if self.get_num_docs() == -1:
+        if num_docs == -1:
             print "no documents"
+            self.doc_vectors = {}
+            self.doc_norms = {}
+            self.tf_idf_num_docs = -1
+            self.tf_idf_doc_counts = {}
+            self.df_tokens = {}
+            self.removed_term_ids = set()
+            self.stale_impact_tokens = set()
             return
 
+        changed_tokens = set(changed_tokens)
+        if self.tf_idf_num_docs != -1 and num_docs != self.tf_idf_num_docs:
+            for doc_count, tokens in self.df_tokens.iteritems():
+                if num_docs/doc_count != self.tf_idf_num_docs/doc_count:
+                    changed_tokens.update(tokens)
+        self.tf_idf_num_docs = num_docs
 
-        token_list = self.get_vocabulary()
-        token_mapping = self.get_vocabulary(return_type="dict")
-        num_tokens = len(token_list)
-        for token in token_list:
+        # tf-idf of the changed tokens, and their terms by doc
+        changed_term_ids = self.removed_term_ids
+        self.removed_term_ids = set()
+        doc_terms = dict()
+        for token in changed_tokens:
+            doc_count = self.tf_idf_doc_counts.pop(token, None)
+            if doc_count is not None:
+                self.df_tokens[doc_count].discard(token)
+                if not self.df_tokens[doc_count]:
+                    del self.df_tokens[doc_count]
             token_obj = self.get_token(token)
-            doc_count = len(token_obj.doc_list)
-            idf = math.log(self.get_num_docs()/doc_count)
-            # reduce idf if the token is a stop word
-            if utils.is_stop_word(token):
-                idf /= 2                        # modify this based on experiments
+            # removed
+            if not token_obj:
+                continue
+            term_id = self.term_ids[token]
+            changed_term_ids.add(term_id)
+            doc_count = token_obj.get_doc_count()
+            idf = self.get_idf(token, doc_count, num_docs)
             token_obj.features["doc_count"] = doc_count
             token_obj.features["idf"] = idf
-            for doc in token_obj.doc_list:
-                tf = doc["features"]["tf"]
+            self.tf_idf_doc_counts[token] = doc_count
+            self.df_tokens.setdefault(doc_count, set()).add(token)
+            for position, doc_id in enumerate(token_obj.doc_ids):
+                tf = token_obj.tfs[position]
                 # similarly, other metrics can also be put
                 tf_idf = tf*idf
-                doc["features"]["tf-idf"] = tf_idf
-                # populate entry in doc-term tf-idf adjascency list
-                if doc["id"] not in self.doc_term_tf_idf:
-                    self.doc_term_tf_idf[doc["id"]] = [0] * num_tokens
-                self.doc_term_tf_idf[doc["id"]][token_mapping[token]] = tf_idf
+                token_obj.tf_idfs[position] = tf_idf
+                doc_terms.setdefault(doc_id, []).append((term_id, tf_idf))
+
+        # rebuild the rows of the docs with a changed term: its other terms are kept
+        impact_tokens = set(changed_tokens)
+        for doc_id in set(changed_docs) | set(doc_terms):
+            tokens = self.doc_tokens.get(doc_id)
+            if not tokens:
+                self.doc_vectors.pop(doc_id, None)
+                self.doc_norms.pop(doc_id, None)
+                continue
+            values = dict(doc_terms.get(doc_id, []))
+            if doc_id in self.doc_vectors:
+                for term_id, tf_idf in zip(*self.doc_vectors[doc_id]):
+                    if term_id not in changed_term_ids:
+                        values[term_id] = tf_idf
+            term_ids = sorted(values)
+            self.doc_vectors[doc_id] = (array('l', term_ids), array('d', [values[term_id] for term_id in term_ids]))
+            # summed in the order of the vocabulary, like every other norm
+            squares = [values[self.term_ids[token]] for token in sorted(tokens)]
+            self.doc_norms[doc_id] = math.sqrt(sum(tf_idf * tf_idf for tf_idf in squares))
+            impact_tokens.update(tokens)
+
+        self.stale_impact_tokens.update(token for token in impact_tokens if token in self.collection)
+
+    def build_impacts(self, token_obj):
+        '''
+        builds the impact ordered doc list of a token. The highest impact is an upper bound of what the token adds to
+        the score of any document
+        :param token_obj:
+        :return:
+        '''
+        impacts = []
+        for doc_id, tf_idf in zip(token_obj.doc_ids, token_obj.tf_idfs):
+            doc_norm = self.doc_norms[doc_id]
+            impacts.append((tf_idf / doc_norm if doc_norm else 0.0, doc_id))
+        impacts.sort(key=lambda x: x[0], reverse=True)
+        token_obj.impact_doc_ids = map(lambda x: x[1], impacts)
+        token_obj.impacts = array('d', map(lambda x: x[0], impacts))
+        token_obj.features["max_impact"] = token_obj.impacts[0] if impacts else 0.0
+
+    def copy(self):
+        '''
+        returns a copy of the postings that can be changed without changing these. The rows of the doc-term matrix
+        and the impact lists are replaced rather than changed, so they are shared
+        :return:
+        '''
+        postings = Postings()
+        postings.collection = dict((token, token_obj.copy()) for token, token_obj in self.collection.iteritems())
+        postings.total_docs = self.total_docs
+        postings.vocabulary = list(self.vocabulary)
+        postings.docs = list(self.docs)
+        postings.term_ids = dict(self.term_ids)
+        postings.next_term_id = self.next_term_id
+        postings.doc_vectors = dict(self.doc_vectors)
+        postings.doc_norms = dict(self.doc_norms)
+        postings.tf_idf_computed = self.tf_idf_computed
+        postings.tf_idf_stale = self.tf_idf_stale
+        postings.changed_tokens = set(self.changed_tokens)
+        postings.changed_docs = set(self.changed_docs)
+        postings.removed_term_ids = set(self.removed_term_ids)
+        postings.stale_impact_tokens = set(self.stale_impact_tokens)
+        postings.tf_idf_num_docs = self.tf_idf_num_docs
+        postings.tf_idf_doc_counts = dict(self.tf_idf_doc_counts)
+        postings.df_tokens = dict((doc_count, set(tokens)) for doc_count, tokens in self.df_tokens.iteritems())
+        if self.doc_tokens is not None:
+            postings.doc_tokens = dict((doc_id, set(tokens)) for doc_id, tokens in self.doc_tokens.iteritems())
+        postings.phrase_index = self.phrase_index
+        postings.mapping_storage = self.mapping_storage
+        return postings
+
+    def get_doc_vector(self, doc_id):
+        '''
+        returns the non-zero terms of a document as a dict of term id to tf-idf
+        :param doc_id:
+        :return:
+        '''
+        self.refresh_tf_idf()
+        term_ids, tf_idfs = self.doc_vectors[doc_id]
+        return dict(zip(term_ids, tf_idfs))
+
+    def get_top_k_documents(self, query_token_frequencies, k):
+        '''
+        returns the k documents most similar to the query, by cosine similarity of tf-idf vectors, as (doc id, score)
+        pairs. Documents that have none of the query tokens are not considered.
+        The dot products are accumulated over the postings of the query's tokens only, and divided by the precomputed
+        document norms. Zero vectors have a similarity of 0.
+        :param query_token_frequencies: dict of query token to its frequency in the query
+        :param k:
+        :return:
+        '''
+        self.refresh_tf_idf()
+        dot_products = dict()
+        query_norm = 0.0
+        for token, frequency in query_token_frequencies.items():
+            token_obj = self.get_token(token)
+            if token_obj:
+                q_tf_idf = frequency * token_obj.features["idf"]
+                query_norm += q_tf_idf * q_tf_idf
+                for doc_id, tf_idf in zip(token_obj.doc_ids, token_obj.tf_idfs):
+                    dot_products[doc_id] = dot_products.get(doc_id, 0.0) + q_tf_idf * tf_idf
+        query_norm = math.sqrt(query_norm)
+
+        results = []
+        for doc_id, dot_product in dot_products.items():
+            doc_norm = self.doc_norms[doc_id]
+            results.append((doc_id, dot_product / (query_norm * doc_norm) if query_norm and doc_norm else 0.0))
+        # partial selection of the top k. Ties go to the earlier document
+        return heapq.nlargest(k, results, key=lambda x: (x[1], -self.get_doc_rank(x[0])))
+
+    def get_document_score(self, doc_id, query_terms, query_norm):
+        '''
+        returns the cosine similarity of a document with the query. Looks up the query's terms in the document's row
+        of the doc-term matrix. Sums in the same order as get_top_k_documents, so the scores are identical
+        :param doc_id:
+        :param query_terms: list of (term id, query tf-idf)
+        :param query_norm:
+        :return:
+        '''
+        term_ids, tf_idfs = self.doc_vectors[doc_id]
+        end = len(term_ids)
+        dot_product = 0.0
+        for term_id, q_tf_idf in query_terms:
+            position = bisect_left(term_ids, term_id)
+            if position < end and term_ids[position] == term_id:
+                dot_product += q_tf_idf * tf_idfs[position]
+        doc_norm = self.doc_norms[doc_id]
+        return dot_product / (query_norm * doc_norm) if query_norm and doc_norm else 0.0
+
+    def get_top_k_documents_pruned(self, query_token_frequencies, k):
+        '''
+        returns the same top k as get_top_k_documents without scoring every document that has a query token.
+        Uses the threshold algorithm over the impact ordered doc lists: the lists of the query's tokens are walked
+        together, highest impact first, and every newly seen document is scored fully. The impacts at the current depth
+        bound the score of any unseen document; once the k-th best score beats that bound, the walk stops.
+        :param query_token_frequencies: dict of query token to its frequency in the query
+        :param k:
+        :return:
+        '''
+        self.refresh_tf_idf()
+        query_tokens = []
+        query_terms = []
+        query_norm = 0.0
+        for token, frequency in query_token_frequencies.items():
+            token_obj = self.get_token(token)
+            if token_obj:
+                if token in self.stale_impact_tokens:
+                    self.build_impacts(token_obj)
+                    self.stale_impact_tokens.discard(token)
+                q_tf_idf = frequency * token_obj.features["idf"]
+                query_norm += q_tf_idf * q_tf_idf
+                query_tokens.append((token_obj, q_tf_idf))
+                query_terms.append((self.term_ids[token], q_tf_idf))
+        query_norm = math.sqrt(query_norm)
+
+        # min heap of the best k so far
+        top_k = []
+        seen = set()
+        depth = 0
+        while k > 0:
+            bound = 0.0
+            walked = False
+            for token_obj, q_tf_idf in query_tokens:
+                if depth < len(token_obj.impact_doc_ids):
+                    walked = True
+                    doc_id = token_obj.impact_doc_ids[depth]
+                    if doc_id not in seen:
+                        seen.add(doc_id)
+                        entry = (self.get_document_score(doc_id, query_terms, query_norm), -self.get_doc_rank(doc_id), doc_id)
+                        if len(top_k) < k:
+                            heapq.heappush(top_k, entry)
+                        elif entry > top_k[0]:
+                            heapq.heapreplace(top_k, entry)
+                    bound += q_tf_idf * token_obj.impacts[depth]
+            if not walked:
+                break
+            # a little slack for rounding, as the bound is computed differently from the scores
+            if len(top_k) == k and query_norm and top_k[0][0] > bound / query_norm * (1 + 1e-9):
+                break
+            depth += 1
+        return map(lambda x: (x[2], x[0]), sorted(top_k, reverse=True))
+
+    def dump(self, file_path, source_hash=""):
+        '''
+        Writes the postings in the on-disk format, to be opened with MappedPostings.
+        Doc ids have to be integers. The file is written under a temporary name and renamed, so readers never see
+        a partial file.
+        :param file_path:
+        :param source_hash: up to 16 bytes identifying what the postings were built from
+        :return:
+        '''
+        self.refresh_tf_idf()
+        encoded_tokens = sorted((token.encode("utf-8") if type(token) == unicode else token, token) for token in self.collection)
+        vocabulary_offsets = array('l', [0])
+        postings_offsets = array('l', [0])
+        idfs = array('d')
+        doc_ids = array('l')
+        tfs = array('d')
+        tf_idfs = array('d')
+        for encoded_token, token in encoded_tokens:
+            token_obj = self.get_token(token)
+            vocabulary_offsets.append(vocabulary_offsets[-1] + len(encoded_token))
+            postings_offsets.append(postings_offsets[-1] + token_obj.get_doc_count())
+            idfs.append(token_obj.features.get("idf", 0.0))
+            if type(token_obj.doc_ids) != array:
+                raise ValueError("only integer doc ids can be dumped, %r has others" % token)
+            doc_ids.extend(token_obj.doc_ids)
+            tfs.extend(token_obj.tfs)
+            tf_idfs.extend(token_obj.tf_idfs)
+
+        num_tokens = len(encoded_tokens)
+        num_postings = len(doc_ids)
+        temp_file_path = "%s.%d.tmp" % (file_path, os.getpid())
+        with open(temp_file_path, "wb") as data_file:
+            data_file.write(POSTINGS_FILE_HEADER.pack(POSTINGS_FILE_MAGIC, POSTINGS_FILE_VERSION, num_tokens,
+                                                      num_postings, self.get_num_docs(), source_hash))
+            write_array(data_file, "q", vocabulary_offsets)
+            write_array(data_file, "q", postings_offsets)
+            write_array(data_file, "d", idfs)
+            write_array(data_file, "q", doc_ids)
+            write_array(data_file, "d", tfs)
+            write_array(data_file, "d", tf_idfs)
+            data_file.write("".join(map(lambda x: x[0], encoded_tokens)))
+        os.rename(temp_file_path, file_path)
+
+
+class MappedPostingsNode:
+    # A token of MappedPostings. Reads its docs from the mapped file when asked for them.
+    def __init__(self, postings, token, index):
+        self.postings = postings
+        self.token = token
+        self.index = index
+        self.start, self.end = postings.get_postings_range(index)
+        self.features = {
+            "doc_count": self.end - self.start,
+            "idf": postings.read_array("d", postings.idf_offset, index, 1)[0]
+        }
+
+    def get_doc_ids(self):
+        return self.postings.read_array("q", self.postings.doc_ids_offset, self.start, self.end - self.start)
+
+    def get_doc_id_set(self):
+        return set(self.get_doc_ids())
+
+    def get_doc_id_array(self):
+        # read in place, without copying
+        return numpy.frombuffer(self.postings.buffer, dtype="<i8", count=self.end - self.start,
+                                offset=self.postings.doc_ids_offset + 8 * self.start)
+
+    @property
+    def doc_list(self):
+        count = self.end - self.start
+        tfs = self.postings.read_array("d", self.postings.tf_offset, self.start, count)
+        tf_idfs = self.postings.read_array("d", self.postings.tf_idf_offset, self.start, count)
+        return [{"id": doc_id, "features": {"tf": tf, "tf-idf": tf_idf}}
+                for doc_id, tf, tf_idf in zip(self.get_doc_ids(), tfs, tf_idfs)]
+
+
+class MappedPostings:
+    # Read-only postings backed by a file written by Postings.dump.
+    # The file is memory mapped and read in place: nothing is deserialised when it is opened, and all the worker
+    # processes on a host share its pages.
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as data_file:
+            self.buffer = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buffer) < POSTINGS_FILE_HEADER.size:
+            raise ValueError("not a postings file: %s" % file_path)
+        magic, version, self.num_tokens, self.num_postings, self.total_docs, self.source_hash = \
+            POSTINGS_FILE_HEADER.unpack_from(self.buffer, 0)
+        if magic != POSTINGS_FILE_MAGIC or version != POSTINGS_FILE_VERSION:
+            raise ValueError("not a postings file: %s" % file_path)
+        # offsets of the arrays
+        self.vocabulary_offsets_offset = POSTINGS_FILE_HEADER.size
+        self.postings_offsets_offset = self.vocabulary_offsets_offset + 8 * (self.num_tokens + 1)
+        self.idf_offset = self.postings_offsets_offset + 8 * (self.num_tokens + 1)
+        self.doc_ids_offset = self.idf_offset + 8 * self.num_tokens
+        self.tf_offset = self.doc_ids_offset + 8 * self.num_postings
+        self.tf_idf_offset = self.tf_offset + 8 * self.num_postings
+        self.vocabulary_offset = self.tf_idf_offset + 8 * self.num_postings
+        # utils.PhraseIndex of the mapping the postings were built from, if they index one
+        self.phrase_index = None
+        # how that mapping is stored in redis: "json" or "hash"
+        self.mapping_storage = "json"
+
+    def read_array(self, type_code, array_offset, index, count):
+        '''
+        returns count elements of a flat array in the file, starting at index
+        :param type_code: struct type code of the elements, all of which are 8 bytes
+        :param array_offset:
+        :param index:
+        :param count:
+        :return:
+        '''
+        return struct.unpack_from("<%d%s" % (count, type_code), self.buffer, array_offset + 8 * index)
+
+    def get_encoded_token(self, index):
+        start, end = self.read_array("q", self.vocabulary_offsets_offset, index, 2)
+        return self.buffer[self.vocabulary_offset + start:self.vocabulary_offset + end]
+
+    def get_postings_range(self, index):
+        return self.read_array("q", self.postings_offsets_offset, index, 2)
+
+    def get_token_index(self, token):
+        '''
+        binary search for a token in the sorted vocabulary. returns -1 if not there
+        :param token:
+        :return:
+        '''
+        encoded_token = token.encode("utf-8") if type(token) == unicode else token
+        low, high = 0, self.num_tokens
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_encoded_token(middle) < encoded_token:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.num_tokens and self.get_encoded_token(low) == encoded_token:
+            return low
+        return -1
+
+    def get_token(self, token, default_value=None):
+        index = self.get_token_index(token)
+        if index == -1:
+            return default_value
+        return MappedPostingsNode(self, token, index)
+
+    def get_num_docs(self):
+        return self.total_docs
+
+    def get_vocabulary(self):
+        return [self.get_encoded_token(index).decode("utf-8") for index in xrange(self.num_tokens)]
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,194 @@
+import os
+import time
+import json
+import zlib
+import pika
+from pika import exceptions
+
+
+class PublishError(Exception):
+    # The broker did not confirm a published message
+    pass
+
+
+def get_partition(s_id, num_partitions):
+    # crc32 is the same in every process and on every machine, unlike hash()
+    if type(s_id) == unicode:
+        s_id = s_id.encode("utf-8")
+    return (zlib.crc32(str(s_id)) & 0xffffffff) % num_partitions
+
+
+def get_partition_queue(celery_configs, partition):
+    return "%s_PARTITION_%d" % (celery_configs["CHAT_TO_FB"], partition)
+
+
+def get_partition_task_queue(celery_configs, partition):
+    # the celery queue the chat_to_fb tasks of a partition are sent to
+    return get_partition_queue(celery_configs, partition) + "_TASKS"
+
+
+def get_response_destination(celery_configs, s_id, c_id):
+    '''
+    returns the exchange and the routing key to publish the responses of a conversation to.
+    In the "queue" outbound mode, they go to a queue per conversation on the default exchange.
+    In the "topic" mode, they go to the outbound topic exchange, which routes them to one of OUTBOUND_PARTITIONS queues
+    picked by the sender id. All the responses for a sender go to the same queue, so they stay in order.
+    :param celery_configs:
+    :param s_id:
+    :param c_id:
+    :return:
+    '''
+    if celery_configs.get("OUTBOUND_MODE", "queue") == "topic":
+        partition = get_partition(s_id, celery_configs["OUTBOUND_PARTITIONS"])
+        return celery_configs["OUTBOUND_EXCHANGE"], "%s.%d.%s.%s" % (celery_configs["CHAT_TO_FB"], partition, s_id, c_id)
+    return "", celery_configs["CHAT_TO_FB"] + "_" + s_id + "_" + c_id
+
+
+class Publisher:
+    # A worker's long-lived broker connection, with one open channel per exchange published to.
+    # The connection is opened on the first publish, so every forked worker process gets its own. It is reopened when
+    # the broker drops it, and heartbeats are processed before every publish so that an idle worker is not dropped.
+    # It has the basic_publish of a pika channel and can be used in its place.
+
+    def __init__(self, celery_configs):
+        self.configs = celery_configs
+        self.heartbeat = celery_configs.get("RABBIT_HEARTBEAT", 60)
+        # with publisher confirms, every publish waits for the broker to confirm the message
+        self.confirm_delivery = celery_configs.get("RABBIT_CONFIRM_DELIVERY", False)
+        # times a publish is retried on a new connection
+        self.max_retries = celery_configs.get("RABBIT_PUBLISH_RETRIES", 1)
+        self.connection = None
+        self.channels = {}
+        self.pid = None
+
+    def get_parameters(self):
+        credentials = pika.PlainCredentials(self.configs["RABBIT_USR"], self.configs["RABBIT_PASS"])
+        return pika.ConnectionParameters(self.configs["RABBIT_IP"],
+                                         self.configs["RABBIT_PORT"],
+                                         self.configs["RABBIT_VHOST"],
+                                         credentials,
+                                         socket_timeout=self.configs["RABBIT_SCKT_TIMEOUT"],
+                                         heartbeat=self.heartbeat)
+
+    def get_connection(self):
+        '''
+        returns the open connection of this process, opening it if required
+        :return:
+        '''
+        # a connection inherited from the parent process is left to the parent
+        if self.pid != os.getpid():
+            self.connection = None
+            self.channels = {}
+            self.pid = os.getpid()
+        if self.connection is None or not self.connection.is_open:
+            self.connection = pika.BlockingConnection(self.get_parameters())
+            self.channels = {}
+        else:
+            # send and receive heartbeats, and find out if the broker closed the connection
+            self.connection.process_data_events(0)
+        return self.connection
+
+    def get_channel(self, name):
+        '''
+        returns the open channel with the given name, opening it if required
+        :param name:
+        :return:
+        '''
+        connection = self.get_connection()
+        channel = self.channels.get(name)
+        if channel is None or not channel.is_open:
+            channel = connection.channel()
+            if self.confirm_delivery:
+                channel.confirm_delivery()
+            self.channels[name] = channel
+        return channel
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        '''
+        publishes a message. If the connection or the channel was lost, publishes it again on a new one.
+        Raises PublishError if publisher confirms are on and the broker rejects the message
+        :param exchange:
+        :param routing_key:
+        :param body:
+        :param properties:
+        :return:
+        '''
+        retries = 0
+        while True:
+            try:
+                # a channel per exchange, so that an error on one does not close the others
+                published = self.get_channel(exchange).basic_publish(exchange=exchange, routing_key=routing_key,
+                                                                     body=body, properties=properties)
+                break
+            except (exceptions.AMQPConnectionError, exceptions.AMQPChannelError):
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                self.reset()
+        # pika versions before 1.0 return False for a rejected message. Later ones raise
+        if self.confirm_delivery and published is False:
+            raise PublishError("message to %r with routing key %r was not confirmed" % (exchange, routing_key))
+
+    def reset(self):
+        '''
+        drops the connection and its channels. They are reopened on the next publish
+        :return:
+        '''
+        connection = self.connection
+        self.connection = None
+        self.channels = {}
+        if connection is not None and self.pid == os.getpid():
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.reset()
+
+
+class ResponseBatch:
+    # Collects the responses of a turn and publishes them as one message: a json list of the responses, in the order
+    # they were added, which is the format a single response is published in.
+    # It is flushed at the end of the turn, before an action that can block (an api call or a function), or earlier
+    # once its oldest response has waited for the latency budget.
+    # Other messages are published right away. It can be used in place of a channel.
+
+    def __init__(self, channel, latency_budget=None):
+        self.channel = channel
+        # seconds
+        self.latency_budget = latency_budget
+        self.exchange = None
+        self.routing_key = None
+        self.payloads = []
+        self.started_at = None
+
+    def add(self, exchange, routing_key, payload):
+        '''
+        adds a response to the batch. A response for another destination flushes the batch first
+        :param exchange:
+        :param routing_key:
+        :param payload:
+        :return:
+        '''
+        if self.payloads and (exchange, routing_key) != (self.exchange, self.routing_key):
+            self.flush()
+        if not self.payloads:
+            self.started_at = time.time()
+            self.exchange = exchange
+            self.routing_key = routing_key
+        self.payloads.append(payload)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.payloads and self.latency_budget is not None and time.time() - self.started_at >= self.latency_budget:
+            self.flush()
+
+    def flush(self):
+        if self.payloads:
+            payloads = self.payloads
+            self.payloads = []
+            self.channel.basic_publish(exchange=self.exchange, routing_key=self.routing_key, body=json.dumps(payloads))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
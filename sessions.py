@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import hashlib
+import datetime
+import threading
+import traceback
+import dateutil.parser
+from collections import OrderedDict
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def get_session_key(c_id, s_id):
+    key = "%s:%s" % (c_id, s_id)
+    if type(key) == unicode:
+        key = key.encode("utf-8")
+    return key
+
+
+class SessionJSONEncoder(json.JSONEncoder):
+    # Keeps the types that json does not have, that the db does, as {"__type__": ..., "value": ...} objects that
+    # session_json_decoder turns back into them. Sets are stored as lists, like in the db
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return {"__type__": "__datetime__", "value": o.isoformat()}
+        elif isinstance(o, ObjectId):
+            return {"__type__": "__objectid__", "value": str(o)}
+        elif isinstance(o, set):
+            return list(o)
+        return json.JSONEncoder.default(self, o)
+
+
+def session_json_decoder(obj):
+    if '__type__' in obj:
+        if obj['__type__'] == '__datetime__':
+            return dateutil.parser.parse(obj["value"])
+        if obj['__type__'] == '__objectid__':
+            return ObjectId(obj["value"])
+    return obj
+
+
+def get_shard_queues(celery_configs):
+    return ["%s_SHARD_%d" % (celery_configs["CHAT_FROM_FB"], shard) for shard in xrange(celery_configs["TURN_SHARDS"])]
+
+
+class HashRing:
+    # A consistent hash ring. Every node is placed on the ring at a number of points, and a key belongs to the node at
+    # the first point after the hash of the key. Adding or removing a node only moves the keys of its own points.
+    # md5 is the same in every process and on every machine, unlike hash()
+
+    def __init__(self, nodes, replicas=100):
+        # sorted list of (point, node)
+        points = []
+        for node in nodes:
+            for replica in xrange(replicas):
+                points.append((self.get_point("%s#%d" % (node, replica)), node))
+        points.sort()
+        self.points = [point for point, node in points]
+        self.nodes = [node for point, node in points]
+
+    def get_point(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        i = bisect.bisect(self.points, self.get_point(key))
+        # wrap around the ring
+        return self.nodes[i % len(self.nodes)]
+
+
+class SessionCache:
+    # A per-process LRU of the sessions of the users whose turns this worker has run: their user document and their
+    # chat history document. It is only valid while the worker is the only one to run the turns of its users, ie. when
+    # turns are sharded by user. Sessions expire after ttl seconds, which bounds how stale one can be after the shards
+    # are changed.
+
+    def __init__(self, max_sessions=10000, ttl=600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # session key -> (stored at, user, chat history document)
+        self.sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, c_id, s_id):
+        '''
+        removes the session of a user from the cache and returns its user and chat history documents, or None if it is
+        not cached. A turn takes the session and puts it back once it is stored, so a turn that fails leaves nothing
+        behind and the next one reads the db
+        :param c_id:
+        :param s_id:
+        :return:
+        '''
+        cached = self.sessions.pop(get_session_key(c_id, s_id), None)
+        if cached is None or time.time() - cached[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached[1], cached[2]
+
+    def put(self, c_id, s_id, user, chat_history_doc):
+        '''
+        caches the user and chat history documents of a user, as they are stored in the db
+        :param c_id:
+        :param s_id:
+        :param user:
+        :param chat_history_doc:
+        :return:
+        '''
+        key = get_session_key(c_id, s_id)
+        # most recently used go last
+        self.sessions.pop(key, None)
+        self.sessions[key] = (time.time(), user, chat_history_doc)
+        # evict the least recently used
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+
+class SessionStore:
+    # Redis-first session state. A turn reads the user's name, profile info and context from the redis hash
+    # "session" + session key, and the tail of their chat history from the list "sessionhistory" + session key. Both
+    # expire ttl seconds after the session was last written to the db, after which the user is read from the db again.
+    # A turn's writes go to redis only. Its new chat history entries are also appended to "sessionpending" + session key,
+    # and the session is added to the "dirtysessions" set. A flusher thread in every worker process writes the dirty
+    # sessions to the db with bulk writes every flush_interval seconds, so db writes grow with the number of active
+    # sessions rather than with the number of messages. A dirty session does not expire, however far behind the
+    # flushers are.
+    # A flusher locks the sessions it takes, with "sessionflush" + session key, so that two flushers never write the
+    # same session at once, which could write an older context over a newer one and push chat history out of order.
+    # The lock expires after flush_lock_timeout seconds, which must be well above the time a flush takes.
+
+    # expires a session written to the db, unless a turn has made it dirty again since
+    expire_script = '''
+        if redis.call("sismember", KEYS[3], ARGV[1]) == 0 then
+            redis.call("expire", KEYS[1], ARGV[2])
+            redis.call("expire", KEYS[2], ARGV[2])
+        end
+    '''
+
+    # releases the flush locks that are still held by the flush
+    unlock_script = '''
+        for i, key in ipairs(KEYS) do
+            if redis.call("get", key) == ARGV[1] then
+                redis.call("del", key)
+            end
+        end
+    '''
+
+    def __init__(self, redis_object, db, ttl=3600, history_size=10, flush_interval=5, flush_batch=500,
+                 flush_lock_timeout=60):
+        self.redis_object = redis_object
+        self.db = db
+        self.ttl = ttl
+        self.history_size = history_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.flush_lock_timeout = flush_lock_timeout
+        self.expire_written = redis_object.register_script(self.expire_script)
+        self.unlock = redis_object.register_script(self.unlock_script)
+        self.flusher_pid = None
+
+    def dumps(self, value):
+        return json.dumps(value, cls=SessionJSONEncoder)
+
+    def loads(self, value):
+        return json.loads(value, object_hook=session_json_decoder)
+
+    def load(self, c_id, s_id):
+        '''
+        returns the user and chat history documents of a user from redis, like they are read from the db, or None if
+        the user has no session in redis
+        :param c_id:
+        :param s_id:
+        :return:
+        '''
+        key = get_session_key(c_id, s_id)
+        pipe = self.redis_object.pipeline(transaction=False)
+        pipe.hmget("session" + key, ["name", "profile_info", "context"])
+        pipe.lrange("sessionhistory" + key, -1, -1)
+        fields, history = pipe.execute()
+        if fields[2] is None:
+            return None
+        user = {
+            "s_id": s_id,
+            "c_id": c_id,
+            "name": self.loads(fields[0]),
+            "profile_info": self.loads(fields[1]),
+            "context": self.loads(fields[2])
+        }
+        return user, {"chathistory": [self.loads(entry) for entry in history]}
+
+    def save(self, c_id, s_id, user, new_chat_history):
+        '''
+        stores the session of a user after a turn, and marks it to be written to the db
+        :param c_id:
+        :param s_id:
+        :param user:
+        :param new_chat_history: the chat history entries added by the turn
+        :return:
+        '''
+        key = get_session_key(c_id, s_id)
+        entries = [self.dumps(entry) for entry in new_chat_history]
+        # in a transaction, so that a flush never sees half a turn
+        pipe = self.redis_object.pipeline()
+        pipe.hmset("session" + key, {
+            "name": self.dumps(user["name"]),
+            "profile_info": self.dumps(user["profile_info"]),
+            "context": self.dumps(user["context"])
+        })
+        if entries:
+            pipe.rpush("sessionhistory" + key, *entries)
+            pipe.ltrim("sessionhistory" + key, -self.history_size, -1)
+            pipe.rpush("sessionpending" + key, *entries)
+        # until it is written to the db
+        pipe.persist("session" + key)
+        pipe.persist("sessionhistory" + key)
+        pipe.sadd("dirtysessions", json.dumps([c_id, s_id]))
+        pipe.execute()
+        self.start_flusher()
+
+    def flush(self):
+        '''
+        writes up to flush_batch dirty sessions to the db: the context of the user, and the chat history entries added
+        since the last flush. The sessions whose writes fail are marked dirty again, with their chat history entries
+        pending again if it was those that failed. The ones written expire ttl seconds later.
+        Returns the number of sessions written
+        :return:
+        '''
+        members = self.redis_object.spop("dirtysessions", self.flush_batch)
+        if not members:
+            return 0
+        token = uuid.uuid4().hex
+        members = self.lock(members, token)
+        if not members:
+            return 0
+        try:
+            return self.write(members)
+        finally:
+            self.unlock(keys=["sessionflush" + get_session_key(*json.loads(member)) for member in members],
+                        args=[token])
+
+    def lock(self, members, token):
+        '''
+        locks the dirty sessions taken by a flush, and marks the ones that another flusher has locked dirty again, for
+        a later flush. Returns the members of the sessions locked
+        :param members: the members of the dirty sessions set taken by the flush
+        :param token: the value of the locks of the flush
+        :return:
+        '''
+        pipe = self.redis_object.pipeline(transaction=False)
+        for member in members:
+            pipe.set("sessionflush" + get_session_key(*json.loads(member)), token, nx=True,
+                     px=int(self.flush_lock_timeout * 1000))
+        locked = pipe.execute()
+        busy = [member for member, is_locked in zip(members, locked) if not is_locked]
+        if busy:
+            self.redis_object.sadd("dirtysessions", *busy)
+        return [member for member, is_locked in zip(members, locked) if is_locked]
+
+    def write(self, members):
+        '''
+        writes the locked dirty sessions to the db. Returns the number of sessions written
+        :param members: the members of the dirty sessions set taken by the flush
+        :return:
+        '''
+        sessions = [json.loads(member) for member in members]
+        # take the pending entries in a transaction, so that none added by a concurrent turn are lost
+        pipe = self.redis_object.pipeline()
+        for c_id, s_id in sessions:
+            key = get_session_key(c_id, s_id)
+            pipe.hmget("session" + key, ["name", "profile_info", "context"])
+            pipe.lrange("sessionpending" + key, 0, -1)
+            pipe.delete("sessionpending" + key)
+        results = pipe.execute()
+        user_writes = []
+        chat_history_writes = []
+        # the index of the session of every write
+        user_sessions = []
+        chat_history_sessions = []
+        pending = []
+        for i, (c_id, s_id) in enumerate(sessions):
+            fields, entries = results[3 * i], results[3 * i + 1]
+            pending.append(entries)
+            query = {"s_id": s_id, "c_id": c_id}
+            if fields[2] is not None:
+                # as a turn stores a user: all of a new one, only the context of an existing one
+                user_writes.append(UpdateOne(query, {
+                    "$set": {"context": self.loads(fields[2])},
+                    "$setOnInsert": {"name": self.loads(fields[0]), "profile_info": self.loads(fields[1])}
+                }, upsert=True))
+                user_sessions.append(i)
+            if entries:
+                chat_history_writes.append(UpdateOne(query, {
+                    "$push": {"chathistory": {"$each": [self.loads(entry) for entry in entries]}}
+                }, upsert=True))
+                chat_history_sessions.append(i)
+        # The chat history writes push entries, so only the ones known to have failed are retried. The user writes set
+        # the same values however many times they are made
+        failed_users = set()
+        failed_chat_histories = set()
+        try:
+            if user_writes:
+                failed_users = self.bulk_write(self.db.users, user_writes, user_sessions)
+        except Exception:
+            # the chat history writes were not made
+            self.retry(members, sessions, pending, user_sessions, chat_history_sessions)
+            raise
+        try:
+            if chat_history_writes:
+                failed_chat_histories = self.bulk_write(self.db.chathistory, chat_history_writes, chat_history_sessions)
+        except Exception:
+            # Which of the chat history writes were made is not known, eg. when the connection is lost. They are all
+            # retried, so that no entries are lost
+            self.retry(members, sessions, pending, failed_users, chat_history_sessions)
+            raise
+        failed = failed_users | failed_chat_histories
+        if failed:
+            self.retry(members, sessions, pending, failed_users, failed_chat_histories)
+            print "failed to flush %d sessions" % len(failed)
+        pipe = self.redis_object.pipeline()
+        for i, (c_id, s_id) in enumerate(sessions):
+            if i not in failed:
+                key = get_session_key(c_id, s_id)
+                self.expire_written(keys=["session" + key, "sessionhistory" + key, "dirtysessions"],
+                                    args=[members[i], self.ttl], client=pipe)
+        pipe.execute()
+        return len(sessions) - len(failed)
+
+    def bulk_write(self, collection, writes, write_sessions):
+        '''
+        makes the writes in any order, and returns the indexes of the sessions whose writes failed. Raises the errors
+        of writes that failed as a whole
+        :param collection:
+        :param writes:
+        :param write_sessions: the index of the session of every write
+        :return:
+        '''
+        try:
+            collection.bulk_write(writes, ordered=False)
+        except BulkWriteError as e:
+            return set(write_sessions[error["index"]] for error in e.details["writeErrors"])
+        return set()
+
+    def retry(self, members, sessions, pending, failed_users, failed_chat_histories):
+        '''
+        marks the sessions whose writes failed dirty again, and puts the pending entries of the ones whose chat history
+        writes failed back in front of any added since. No other flusher can have written those, as the sessions are
+        locked
+        :param members: the members of the dirty sessions set taken by the flush
+        :param sessions:
+        :param pending: the pending entries taken for every session
+        :param failed_users: the indexes of the sessions whose user writes failed
+        :param failed_chat_histories: the indexes of the sessions whose chat history writes failed
+        :return:
+        '''
+        pipe = self.redis_object.pipeline()
+        for i in failed_chat_histories:
+            c_id, s_id = sessions[i]
+            pipe.lpush("sessionpending" + get_session_key(c_id, s_id), *reversed(pending[i]))
+        failed = set(failed_users) | set(failed_chat_histories)
+        if failed:
+            pipe.sadd("dirtysessions", *[members[i] for i in failed])
+        pipe.execute()
+
+    def start_flusher(self):
+        # a flusher per process, started with its first save, since worker processes are forked
+        if self.flusher_pid != os.getpid():
+            self.flusher_pid = os.getpid()
+            flusher = threading.Thread(target=self.run_flusher)
+            flusher.daemon = True
+            flusher.start()
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                # a full batch means there may be more
+                while self.flush() == self.flush_batch:
+                    pass
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
@@ -2,7 +2,9 @@ from __future__ import absolute_import, unicode_literals
 import sys
 import os
 from celery_chat import app
-from graph import Graph
+from graph import GraphRegistry
+from publisher import Publisher, ResponseBatch
+from sessions import SessionCache, SessionStore
 import actions
 import utils
 
@@ -64,16 +66,42 @@ action_configs["celery"] = configs["celery"]
 db_client = MongoClient(configs["database"])
 db = db_client.get_database("chat")
 # Build a redis connection
-# get a redis connection
-r = redis.StrictRedis(host="localhost", port=6379, charset="utf-8", decode_responses=True)
+# get a redis connection. It shares the connection pool used for extraction
+r = redis.StrictRedis(connection_pool=utils.redis_pool)
+# decoded mappings are cached up to this many bytes of their json
+utils.mapping_cache.max_size = configs.get("mappings", {}).get("cache_size", utils.mapping_cache.max_size)
 
-# load all graphs
-chat_graphs = dict()
+# graphs are loaded when a company is first seen, and the least recently used ones are evicted
+# hot companies can be loaded upfront
+graph_configs = configs.get("graphs", {})
 graphs_path = "chatbot/graphs/"
-for company_id in os.listdir(graphs_path):
-    chat_graph = Graph(company_id)
-    chat_graph.populate_graph(os.path.realpath(graphs_path + "/" + company_id), db, r, extraction_indices)
-    chat_graphs[company_id] = chat_graph
+chat_graphs = GraphRegistry(graphs_path, db, r, extraction_indices,
+                            max_graphs=graph_configs.get("max_loaded", 0),
+                            max_weight=graph_configs.get("max_weight", 0),
+                            reload_interval=graph_configs.get("reload_interval", 0))
+chat_graphs.prewarm(graph_configs.get("prewarm", []))
+
+# Build a broker connection
+# every worker keeps one long-lived connection to publish its responses
+publisher = Publisher(configs["celery"])
+
+# When turns are sharded by user, a worker process is the only one to run the turns of its users, and it keeps their
+# sessions in memory. Otherwise every turn reads them from the session store
+session_configs = configs.get("sessions", {})
+sessions = None
+if configs["celery"].get("TURN_SHARDS"):
+    sessions = SessionCache(max_sessions=session_configs.get("cache_size", 10000),
+                            ttl=session_configs.get("cache_ttl", 600))
+# With the "redis" session store, sessions are read from and written to redis, and written behind to the db.
+# With the "mongo" store, every turn reads and writes the db
+session_store = None
+if session_configs.get("store", "mongo") == "redis":
+    session_store = SessionStore(r, db,
+                                 ttl=session_configs.get("ttl", 3600),
+                                 history_size=session_configs.get("history_size", 10),
+                                 flush_interval=session_configs.get("flush_interval", 5),
+                                 flush_batch=session_configs.get("flush_batch", 500),
+                                 flush_lock_timeout=session_configs.get("flush_lock_timeout", 60))
 
 # FB Bot
 bot = Bot(configs["TOKEN"])
@@ -86,17 +114,11 @@ def chat_from_fb(body):
     current_node = None
     next_node = None
     move = None
-
-    # Connections
-    # Build a broker connection
-    credentials = pika.PlainCredentials(configs["celery"]["RABBIT_USR"], configs["celery"]["RABBIT_PASS"])
-    parameters = pika.ConnectionParameters(configs["celery"]["RABBIT_IP"],
-                                           configs["celery"]["RABBIT_PORT"],
-                                           configs["celery"]["RABBIT_VHOST"],
-                                           credentials,
-                                           socket_timeout=configs["celery"]["RABBIT_SCKT_TIMEOUT"])
-    broker_connection = pika.BlockingConnection(parameters)
-    channel = broker_connection.channel()
+    # the responses of the turn can be published as one message
+    if configs["celery"].get("BATCH_RESPONSES"):
+        channel = ResponseBatch(publisher, configs["celery"].get("BATCH_LATENCY_BUDGET"))
+    else:
+        channel = publisher
 
     # extract info
     message = body_json.get("message", "").replace("\\", "")
@@ -111,16 +133,22 @@ def chat_from_fb(body):
     # set default to "user"
     user_name = r.get(sender_id) or "user"
 
-    # get info from db
-    user = db["users"].find_one({"s_id": sender_id, "c_id": company_id})
-    chat_history_doc = list(db["chathistory"].find({"s_id": sender_id, "c_id": company_id}, {"chathistory": {"$slice": -1}}))
-    if chat_history_doc:
-        chat_history_doc = chat_history_doc[0]
+    # get info from the session cache, or from db
+    session = sessions.take(company_id, sender_id) if sessions is not None else None
+    if session is None and session_store is not None:
+        session = session_store.load(company_id, sender_id)
+    if session is not None:
+        user, chat_history_doc = session
+    else:
+        user = db["users"].find_one({"s_id": sender_id, "c_id": company_id})
+        chat_history_doc = list(db["chathistory"].find({"s_id": sender_id, "c_id": company_id}, {"chathistory": {"$slice": -1}}))
+        if chat_history_doc:
+            chat_history_doc = chat_history_doc[0]
     chat_history = []
     new_chat_history = []
 
     # get the graph per companyID
-    chat_graph = chat_graphs.get(company_id)
+    chat_graph = chat_graphs.get_graph(company_id)
 
     # construct object to be passed everywhere
     # TODO see if this needs to be an actual object rather than a dict
@@ -133,109 +161,112 @@ def chat_from_fb(body):
         "payload": payload,
         "ts": ts
     }
-    # This loop is for moving to a node without user interaction
-    while True:
-        if not user:
-            # New user
-            new_user = True
-            user = {
-                "s_id": sender_id,
-                "c_id": company_id,
-                "name": user_name,
-                "profile_info": {},
-                "context": {
-                    "last_ts": ts,
-                    "last_node": None
-                },
-            }
-            next_node = chat_graph.get_node("welcome")
-            # populate relevant fields in data dict
-            data["name"] = user_name
-            data["profile_info"] = user["profile_info"]
-            data["chat_history"] = chat_history
-            data["context"] = user["context"]
-            data["extraction_indices"] = extraction_indices
-        else:
-            chat_history = chat_history_doc["chathistory"]
-            data["name"] = user["name"]
-            data["profile_info"] = user["profile_info"]
-            data["chat_history"] = chat_history
-            data["context"] = user["context"]
-            data["extraction_indices"] = extraction_indices
-            # clear extraction variables from context
-            if move is None:
-                data["context"]["extraction"] = dict()
-            # Use the graph to get the next node
-            # Or, get a suggestion node from previous context
-            if data["context"].get("prev_node_was_suggestion", False):
-                current_node = chat_graph.get_node("suggestion")
-                current_node.connections = data["context"].get("suggestion_node_connections", [])
-                data["context"]["suggestion_node_connections"] = []
-                next_node = chat_graph.get_next_node(node=current_node, data=data) if move is None else chat_graph.get_node(
-                    move)
+    try:
+        # This loop is for moving to a node without user interaction
+        while True:
+            if not user:
+                # New user
+                new_user = True
+                user = {
+                    "s_id": sender_id,
+                    "c_id": company_id,
+                    "name": user_name,
+                    "profile_info": {},
+                    "context": {
+                        "last_ts": ts,
+                        "last_node": None
+                    },
+                }
+                next_node = chat_graph.get_node("welcome")
+                # populate relevant fields in data dict
+                data["name"] = user_name
+                data["profile_info"] = user["profile_info"]
+                data["chat_history"] = chat_history
+                data["context"] = user["context"]
+                data["extraction_indices"] = extraction_indices
             else:
-                current_node = user.get("context", {}).get("last_node") or None
-                next_node = chat_graph.get_next_node(current_node, data=data) if move is None else chat_graph.get_node(move)
-
-
-        # perform action(s)
-        responses, move = actions.perform_action(next_node.action, data, action_configs, channel)
-        # Update context
-        if data["context"].get("prev_node_was_suggestion", False):
-            data["context"]["prev_node_was_suggestion"] = False
-        if next_node.set_context_vars:
-            for i in next_node.set_context_vars:
-                if type(next_node.set_context_vars[i]) == dict and "var" in next_node.set_context_vars[i]:
-                    user["context"][i] = utils.get_value_from_object(data, next_node.set_context_vars[i]["var"])
+                chat_history = chat_history_doc["chathistory"]
+                data["name"] = user["name"]
+                data["profile_info"] = user["profile_info"]
+                data["chat_history"] = chat_history
+                data["context"] = user["context"]
+                data["extraction_indices"] = extraction_indices
+                # clear extraction variables from context
+                if move is None:
+                    data["context"]["extraction"] = dict()
+                # Use the graph to get the next node
+                # Or, get a suggestion node from previous context
+                if data["context"].get("prev_node_was_suggestion", False):
+                    current_node = chat_graph.get_node("suggestion")
+                    current_node.connections = data["context"].get("suggestion_node_connections", [])
+                    data["context"]["suggestion_node_connections"] = []
+                    next_node = chat_graph.get_next_node(node=current_node, data=data) if move is None else chat_graph.get_node(
+                        move)
                 else:
-                    user["context"][i] = next_node.set_context_vars[i]
-        user["context"]["last_ts"] = ts
-        user["context"]["last_node"] = next_node.name
-        # update chat history
-        to_append = {
-            "m_id": message_id,
-            "ts": ts,
-            "message": message,
-            "payload": payload,
-            "responses": responses,
-            "node": next_node.name
-        }
-        chat_history.append(to_append)      # used for when move operation requires previous chat history
-        new_chat_history.append(to_append)  # used for storing in the DB
-        if move is None:
-            break
+                    current_node = user.get("context", {}).get("last_node") or None
+                    next_node = chat_graph.get_next_node(current_node, data=data) if move is None else chat_graph.get_node(move)
+
+
+            # perform action(s)
+            responses, move = actions.perform_action(next_node.action, data, action_configs, channel)
+            # Update context
+            if data["context"].get("prev_node_was_suggestion", False):
+                data["context"]["prev_node_was_suggestion"] = False
+            if next_node.set_context_vars:
+                for i in next_node.set_context_vars:
+                    if type(next_node.set_context_vars[i]) == dict and "var" in next_node.set_context_vars[i]:
+                        user["context"][i] = utils.get_value_from_object(data, next_node.set_context_vars[i]["var"])
+                    else:
+                        user["context"][i] = next_node.set_context_vars[i]
+            user["context"]["last_ts"] = ts
+            user["context"]["last_node"] = next_node.name
+            # update chat history
+            to_append = {
+                "m_id": message_id,
+                "ts": ts,
+                "message": message,
+                "payload": payload,
+                "responses": responses,
+                "node": next_node.name
+            }
+            chat_history.append(to_append)      # used for when move operation requires previous chat history
+            new_chat_history.append(to_append)  # used for storing in the DB
+            if move is None:
+                break
+            if isinstance(channel, ResponseBatch):
+                channel.flush_if_due()
+    finally:
+        # the responses of a turn that fails are still published, as they are without a batch
+        if isinstance(channel, ResponseBatch):
+            channel.flush()
     # store variables
-    if new_user:
-        db.users.insert(user)
+    if session_store is not None:
+        # the db is written to by the flusher
+        session_store.save(company_id, sender_id, user, new_chat_history)
     else:
-        db.users.update({"s_id": sender_id, "c_id": company_id}, {"$set": {"context": user["context"]}})
-    db.chathistory.update({"s_id": sender_id, "c_id": company_id}, {"$push": {"chathistory": { "$each": new_chat_history}}}, upsert=True)
+        if new_user:
+            db.users.insert(user)
+        else:
+            db.users.update({"s_id": sender_id, "c_id": company_id}, {"$set": {"context": user["context"]}})
+        db.chathistory.update({"s_id": sender_id, "c_id": company_id}, {"$push": {"chathistory": { "$each": new_chat_history}}}, upsert=True)
+    if sessions is not None:
+        # keep what the db would return for the next turn: the user and the last entry of their chat history
+        sessions.put(company_id, sender_id, user, {"chathistory": chat_history[-1:]})
 
 
 @app.task(ignore_result=True)
 def test(body):
     print "test message received"
     print "sending response"
-    # Connections
-    # Build a broker connection
-    credentials = pika.PlainCredentials(configs["celery"]["RABBIT_USR"], configs["celery"]["RABBIT_PASS"])
-    parameters = pika.ConnectionParameters(configs["celery"]["RABBIT_IP"],
-                                           configs["celery"]["RABBIT_PORT"],
-                                           configs["celery"]["RABBIT_VHOST"],
-                                           credentials,
-                                           socket_timeout=configs["celery"]["RABBIT_SCKT_TIMEOUT"])
-    broker_connection = pika.BlockingConnection(parameters)
-    channel = broker_connection.channel()
     try:
-        if not broker_connection.is_closed:
-            channel.basic_publish(exchange='',
-                                  routing_key=configs["celery"]["TEST_RESULT_TASK"],
-                                  body=json.dumps({
-                                      "message": "test response"
-                                  }))
-            print "test response sent"
-        else:
-            print "test failed- broker offline"
+        publisher.basic_publish(exchange='',
+                                routing_key=configs["celery"]["TEST_RESULT_TASK"],
+                                body=json.dumps({
+                                    "message": "test response"
+                                }))
+        print "test response sent"
+    except pika.exceptions.AMQPConnectionError:
+        print "test failed- broker offline"
     except Exception:
         print "test failed - error"
 
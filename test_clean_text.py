@@ -0,0 +1,132 @@
+import re
+import random
+import unittest
+import utils
+
+# Checks that utils.clean_text gives the same output as the implementation of remove_non_alpha_num_chars it replaced.
+# usage: python -m unittest test_clean_text
+
+
+def legacy_remove_non_alpha_num_chars(texts):
+    # remove_non_alpha_num_chars before clean_text, kept as the reference
+    if type(texts) != list:
+        texts = [texts]
+    modified_text = []
+    for text in texts:
+        if type(text) != str:
+            text = str(text)
+        text = text.replace("&amp;", "&")
+        text = text.replace("amp;", "&")
+        text = re.sub('[?!\._]', " ", text, flags=re.I)
+        text = re.findall(r"[\w\.#+]+|['a-z]+|[,'\-:;\/&]", text)
+        new_text  = ""
+        temp_token = ""
+        initial_single_token = True
+        for token in text:
+            if len(token) == 1 and token not in [';', ',', "'", '-', ':', "/", "&"]:
+                if initial_single_token:
+                    initial_single_token = False
+                temp_token = temp_token + token
+            else:
+                if bool(temp_token):
+                    temp_token = temp_token + " "
+                initial_single_token = True
+                new_text = new_text + temp_token + token + " "
+                temp_token = ""
+        new_text = new_text + temp_token
+        new_text = re.sub("[\-;,:'\/]", "", new_text, flags=re.I)
+        new_text = re.sub("[&]", "and", new_text, flags=re.I)
+        modified_text.append(new_text.strip())
+    return modified_text
+
+
+representative_texts = [
+    "Hi, how are you today?",
+    "I want to study computer science in the U.S.A.",
+    "what are the fees for the m.s. program at nyu?",
+    "Tell me about C++ and C# jobs",
+    "i'm looking for a 2-bedroom apartment near 5th ave.",
+    "R&amp;D roles at AT&amp;T; also amp; alone",
+    "the best of the best of the best",
+    "is it a good idea to do an mba after b.tech?",
+    "rock 'n' roll isn't dead",
+    "email me at someone@example.com / call 555-1234",
+]
+
+adversarial_texts = [
+    "",
+    " ",
+    "\t\n",
+    "?!._",
+    "...,,,;;;:::---///&&&'''",
+    "a.b.c.d.e.f",
+    "a b c d",
+    "x'y'z",
+    "''''abc",
+    "'A'",
+    "u.s.a.'s",
+    "__init__",
+    "###+++",
+    "&amp;amp;amp;",
+    "caf\xc3\xa9 na\xc3\xafve r\xc3\xa9sum\xc3\xa9",
+    "\xe2\x80\x9cquoted\xe2\x80\x9d \xe2\x80\x94 dash",
+    u"plain ascii unicode",
+    "MiXeD CaSe AND UPPER",
+    "a" * 1000,
+    "a." * 500,
+    12345,
+    3.5,
+    None,
+    ["a", "list"],
+]
+
+
+def get_random_texts(count, seed=0):
+    # strings over the characters that the tokenizers treat differently
+    alphabet = "abcAB09#+'.,-:;/&?!_ \t" + "\xc3\xa9\xe2\x80\x9c"
+    words = ["amp;", "&amp;", "the", "of", "u.s.", "c++", "isn't", "'s"]
+    rng = random.Random(seed)
+    texts = []
+    for i in xrange(count):
+        parts = []
+        for j in xrange(rng.randint(0, 12)):
+            if rng.random() < 0.2:
+                parts.append(rng.choice(words))
+            else:
+                parts.append("".join(rng.choice(alphabet) for k in xrange(rng.randint(1, 4))))
+        texts.append("".join(parts))
+    return texts
+
+
+class CleanTextTest(unittest.TestCase):
+
+    def assert_same(self, text):
+        try:
+            expected = legacy_remove_non_alpha_num_chars(text)
+        except Exception as e:
+            # e.g. non-ascii unicode, which neither can convert with str()
+            self.assertRaises(type(e), utils.remove_non_alpha_num_chars, text)
+            return
+        self.assertEqual(utils.remove_non_alpha_num_chars(text), expected, repr(text))
+
+    def test_representative(self):
+        for text in representative_texts:
+            self.assert_same(text)
+
+    def test_adversarial(self):
+        for text in adversarial_texts:
+            self.assert_same(text)
+
+    def test_non_ascii_unicode(self):
+        self.assert_same(u"caf\xe9")
+
+    def test_list(self):
+        self.assert_same(representative_texts + adversarial_texts[:-1])
+
+    def test_random(self):
+        for text in get_random_texts(20000):
+            self.assert_same(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import time
+import unittest
+from pymongo.errors import BulkWriteError
+from sessions import SessionStore
+
+# Checks that SessionStore flushes write a session to the db in the order of its turns, however they interleave.
+# Redis and the db are replaced by in-memory fakes that have the commands the store uses.
+# usage: python -m unittest test_sessions
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        if script == SessionStore.expire_script:
+            return self.expire_written
+        if script == SessionStore.unlock_script:
+            return self.unlock
+        raise ValueError(script)
+
+    def expire_written(self, keys, args, client=None):
+        if args[0] not in self.data.get(keys[2], set()):
+            self.expire(keys[0], args[1])
+            self.expire(keys[1], args[1])
+
+    def unlock(self, keys, args, client=None):
+        for key in keys:
+            if self.data.get(key) == args[0]:
+                self.delete(key)
+
+    def set(self, name, value, nx=False, px=None):
+        if nx and name in self.data:
+            return None
+        self.data[name] = value
+        return True
+
+    def hmset(self, name, mapping):
+        self.data.setdefault(name, {}).update(mapping)
+
+    def hmget(self, name, keys):
+        return [self.data.get(name, {}).get(key) for key in keys]
+
+    def rpush(self, name, *values):
+        self.data.setdefault(name, []).extend(values)
+
+    def lpush(self, name, *values):
+        for value in values:
+            self.data.setdefault(name, []).insert(0, value)
+
+    def ltrim(self, name, start, end):
+        self.data[name] = self.lrange(name, start, end)
+
+    def lrange(self, name, start, end):
+        values = self.data.get(name, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def delete(self, name):
+        self.data.pop(name, None)
+        self.expires.pop(name, None)
+
+    def persist(self, name):
+        self.expires.pop(name, None)
+
+    def expire(self, name, ttl):
+        if name in self.data:
+            self.expires[name] = ttl
+
+    def sadd(self, name, *values):
+        self.data.setdefault(name, set()).update(values)
+
+    def spop(self, name, count):
+        values = sorted(self.data.get(name, set()))[:count]
+        for value in values:
+            self.data[name].discard(value)
+        return values
+
+
+class FakePipeline:
+
+    def __init__(self, redis_object):
+        self.redis_object = redis_object
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        results = [getattr(self.redis_object, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.docs = {}
+        # called before the next bulk write is made
+        self.before_write = None
+
+    def bulk_write(self, requests, ordered=True):
+        before_write, self.before_write = self.before_write, None
+        if before_write:
+            before_write()
+        for request in requests:
+            doc = self.docs.setdefault((request._filter["c_id"], request._filter["s_id"]), {})
+            doc.update(request._doc.get("$set", {}))
+            for field, value in request._doc.get("$push", {}).items():
+                doc.setdefault(field, []).extend(value["$each"])
+
+
+class FakeDb:
+
+    def __init__(self):
+        self.users = FakeCollection()
+        self.chathistory = FakeCollection()
+
+
+class SessionStoreFlushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_object = FakeRedis()
+        self.db = FakeDb()
+        self.store = SessionStore(self.redis_object, self.db)
+        # flushes are made by the tests
+        self.store.start_flusher = lambda: None
+
+    def save_turn(self, turn):
+        user = {"name": "user", "profile_info": {}, "context": {"last_node": "node%d" % turn}}
+        self.store.save("company", "sender", user, [{"m_id": "m%d" % turn}])
+
+    def assert_flushed(self, turns):
+        self.assertEqual(self.db.users.docs[("company", "sender")]["context"], {"last_node": "node%d" % turns[-1]})
+        self.assertEqual(self.db.chathistory.docs[("company", "sender")]["chathistory"],
+                         [{"m_id": "m%d" % turn} for turn in turns])
+
+    def test_interleaved_flushes(self):
+        self.save_turn(1)
+
+        def flush_newer_turn():
+            # a turn is stored while the first flush has taken the session but not written it yet, and a second
+            # flush runs to completion
+            self.save_turn(2)
+            self.assertEqual(self.store.flush(), 0)
+        self.db.users.before_write = flush_newer_turn
+        self.assertEqual(self.store.flush(), 1)
+        # the second flush left the session for a later one
+        self.assertEqual(self.store.flush(), 1)
+        self.assert_flushed([1, 2])
+        self.assertEqual(self.store.flush(), 0)
+        self.assertNotIn("sessionflushcompany:sender", self.redis_object.data)
+        self.assertIn("sessioncompany:sender", self.redis_object.expires)
+
+    def test_failed_flush_is_retried_in_order(self):
+        self.save_turn(1)
+
+        def fail():
+            self.save_turn(2)
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 1, "errmsg": "failed"}]})
+        self.db.chathistory.before_write = fail
+        self.assertEqual(self.store.flush(), 0)
+        self.assertEqual(self.store.flush(), 1)
+        self.assert_flushed([1, 2])
+
+    def test_dirty_session_does_not_expire(self):
+        self.save_turn(1)
+        self.assertEqual(self.redis_object.expires, {})
+        self.assertEqual(self.store.flush(), 1)
+        self.save_turn(2)
+        self.assertEqual(self.redis_object.expires, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,8 +12,10 @@ from nltk.stem import PorterStemmer
 from nltk.corpus import stopwords
 from nltk import ngrams
 from scipy import spatial
+import numpy
 import html
 import smtplib
+from collections import OrderedDict
 
 
 def set_configs(config_file):
@@ -89,6 +91,43 @@ def fuzzy_text_matcher(text_in, target):
     return 0
 
 
+# Tokens of a text: words (with # and +), words starting with an apostrophe, and punctuation.
+# Anything else, including ?!._ and whitespace, separates tokens.
+alpha_num_token_regex = re.compile(r"[A-Za-z0-9#+]+|'[a-z']*|[,\-:;/&]")
+# what punctuation tokens are replaced by
+punctuation_replacements = {",": "", "-": "", ":": "", ";": "", "/": "", "'": "", "&": "and"}
+
+
+def clean_text(text):
+    '''
+    strips a text off of all punctuations and standardizes acronyms, e.g. "u.s.a." becomes "usa".
+    Tokenizes the text in one regex scan and builds the result from a list of parts.
+    :param text:
+    :return:
+    '''
+    if type(text) != str:
+        text = str(text)
+    text = text.replace("&amp;", "&").replace("amp;", "&")
+    parts = []
+    single_chars = []
+    for token in alpha_num_token_regex.findall(text):
+        if len(token) == 1 and token not in punctuation_replacements:
+            # consecutive single letters/ digits are merged
+            single_chars.append(token)
+        else:
+            if single_chars:
+                parts.append("".join(single_chars))
+                parts.append(" ")
+                single_chars = []
+            if token[0] == "'":
+                parts.append(token.replace("'", ""))
+            else:
+                parts.append(punctuation_replacements.get(token, token))
+            parts.append(" ")
+    parts.append("".join(single_chars))
+    return "".join(parts).strip()
+
+
 def remove_non_alpha_num_chars(texts):
     '''
     take in a list of texts or a text and return a list of text(s) that have been stripped off of all punctuations
@@ -98,75 +137,99 @@ def remove_non_alpha_num_chars(texts):
     '''
     if type(texts) != list:
         texts = [texts]
-    modified_text = []
-    for text in texts:
-        if type(text) != str:
-            text = str(text)
-        text = text.replace("&amp;", "&")
-        text = text.replace("amp;", "&")
-        text = re.sub('[?!\._]', " ", text, flags=re.I)
-        text = re.findall(r"[\w\.#+]+|['a-z]+|[,'\-:;\/&]", text)
-        new_text  = ""
-        temp_token = ""
-        initial_single_token = True
-        for token in text:
-            if len(token) == 1 and token not in [';', ',', "'", '-', ':', "/", "&"]:
-                if initial_single_token:
-                    initial_single_token = False
-                temp_token = temp_token + token
-            else:
-                if bool(temp_token):
-                    temp_token = temp_token + " "
-                initial_single_token = True
-                new_text = new_text + temp_token + token + " "
-                temp_token = ""
-        new_text = new_text + temp_token
-        new_text = re.sub("[\-;,:'\/]", "", new_text, flags=re.I)
-        new_text = re.sub("[&]", "and", new_text, flags=re.I)
-        modified_text.append(new_text.strip())
-    return modified_text
+    return map(clean_text, texts)
+
+
+class TokenCache:
+    # A bounded LRU of tokens and their normalised forms, with hit-rate counters
+
+    def __init__(self, normalise, max_size=100000):
+        self.normalise = normalise
+        self.max_size = max_size
+        self.tokens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        '''
+        returns the normalised form of a token, normalising it only if it is not cached
+        :param token:
+        :return:
+        '''
+        try:
+            value = self.tokens.pop(token)
+            self.hits += 1
+        except KeyError:
+            value = self.normalise(token)
+            self.misses += 1
+            if len(self.tokens) >= self.max_size:
+                # evict the least recently used
+                self.tokens.popitem(last=False)
+        # most recently used go last
+        self.tokens[token] = value
+        return value
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+# one lemmatizer and stemmer per process, behind caches of their results
+lemmatizer = WordNetLemmatizer()
+stemmer = PorterStemmer()
+lemma_cache = TokenCache(lemmatizer.lemmatize)
+stem_cache = TokenCache(stemmer.stem)
+
+
+def get_normaliser_stats():
+    '''
+    returns the sizes and hit rates of the token caches
+    :return:
+    '''
+    return {
+        "lemma": {"size": len(lemma_cache.tokens), "hits": lemma_cache.hits, "misses": lemma_cache.misses, "hit_rate": lemma_cache.get_hit_rate()},
+        "stem": {"size": len(stem_cache.tokens), "hits": stem_cache.hits, "misses": stem_cache.misses, "hit_rate": stem_cache.get_hit_rate()}
+    }
 
 
-def stem_text(text):
+def normalise_text(text, turn_cache=None):
     '''
-    return a list of stemmed words
+    returns the lemmatized and the stemmed words of a text, from one cleaning of the text.
+    If a per-turn cache (a dict) is given, a text is normalised only once per turn.
     :param text:
+    :param turn_cache:
     :return:
     '''
-
-    # initialization
-    stemmer = PorterStemmer()
-    stemmed_list = []
+    if turn_cache is not None and text in turn_cache:
+        return turn_cache[text]
 
     # get clean text
-    clean_text = remove_non_alpha_num_chars(text)[0]
-
-    # lemmatize each token
-    for token in clean_text.split():
-        stemmed_list.append(stemmer.stem(token))
+    tokens = remove_non_alpha_num_chars(text)[0].split()
+    normalised = ([lemma_cache.get(token) for token in tokens], [stem_cache.get(token) for token in tokens])
 
-    return stemmed_list
+    if turn_cache is not None:
+        turn_cache[text] = normalised
+    return normalised
 
 
-def lemmatize_text(text):
+def stem_text(text, turn_cache=None):
     '''
-    Return a list of lemmatized words
+    return a list of stemmed words
     :param text:
+    :param turn_cache:
     :return:
     '''
+    return list(normalise_text(text, turn_cache)[1])
 
-    # initialization
-    lemmatizer = WordNetLemmatizer()
-    lemmatized_list = []
-
-    # get clean text
-    clean_text = remove_non_alpha_num_chars(text)[0]
-
-    # lemmatize each token
-    for token in clean_text.split():
-        lemmatized_list.append(lemmatizer.lemmatize(token))
 
-    return lemmatized_list
+def lemmatize_text(text, turn_cache=None):
+    '''
+    Return a list of lemmatized words
+    :param text:
+    :param turn_cache:
+    :return:
+    '''
+    return list(normalise_text(text, turn_cache)[0])
 
 
 def remove_stop_words(input_data, input_type="string"):
@@ -241,6 +304,125 @@ def class_check(txt, class_name, utils):
         return 100 if found else 0
 
 
+class ClassEngine:
+    # Compiles the classes in intent utils once.
+    # Works out every class a message belongs to in one pass over the compiled regexes and caches it for the turn,
+    # so that each class check is a set-membership test.
+    # Python's regex alternation reports only the first matching branch, so classes cannot share one pattern
+    # without losing overlapping memberships. Each simple class is matched once per message instead.
+
+    def __init__(self, classes):
+        self.compiled_classes = dict()
+        self.class_members = dict()
+        for class_name, class_regex_expns in classes.items():
+            if isinstance(class_regex_expns, list):
+                self.class_members[class_name] = class_regex_expns
+            else:
+                self.compiled_classes[class_name] = re.compile(class_regex_expns, re.IGNORECASE)
+
+    def get_classes(self, txt):
+        '''
+        returns the set of class names the text belongs to. A class with subclasses is included if any of its
+        subclasses is
+        :param txt:
+        :return:
+        '''
+        found_classes = set(class_name for class_name, class_regex in self.compiled_classes.items() if class_regex.match(txt))
+        for class_name, sub_class_names in self.class_members.items():
+            if any(sub_class_name in found_classes for sub_class_name in sub_class_names):
+                found_classes.add(class_name)
+        return found_classes
+
+    def get_message_classes(self, data):
+        '''
+        returns the set of classes of the message in data. The set is cached in data so that it is computed once per
+        turn
+        :param data:
+        :return:
+        '''
+        message = data.get("message", "")
+        message_classes = data.get("message_classes")
+        if not message_classes or message_classes[0] != message:
+            message_classes = (message, self.get_classes(message))
+            data["message_classes"] = message_classes
+        return message_classes[1]
+
+    def class_check(self, data, class_name):
+        '''
+        Same as class_check, for the message in data.
+        returns 100 if found
+        :param data:
+        :param class_name:
+        :return:
+        '''
+        if class_name not in self.compiled_classes and class_name not in self.class_members:
+            raise KeyError(class_name)
+        return 100 if class_name in self.get_message_classes(data) else 0
+
+
+def logic_and(evaluate, values):
+    '''
+    JSON Logic "and" that stops evaluating values at the first falsy one. Returns what evaluating all of them would
+    :param evaluate: function that evaluates a value
+    :param values:
+    :return:
+    '''
+    result = True
+    for value in values:
+        result = evaluate(value)
+        if not result:
+            return result
+    return result
+
+
+def logic_or(evaluate, values):
+    '''
+    JSON Logic "or" that stops evaluating values at the first truthy one. Returns what evaluating all of them would
+    :param evaluate: function that evaluates a value
+    :param values:
+    :return:
+    '''
+    result = False
+    for value in values:
+        result = evaluate(value)
+        if result:
+            return result
+    return result
+
+
+def logic_if(evaluate, values):
+    '''
+    JSON Logic "?:" that evaluates only the branch that is picked
+    :param evaluate: function that evaluates a value
+    :param values:
+    :return:
+    '''
+    if len(values) != 3:
+        raise TypeError("?: takes exactly 3 arguments (%d given)" % len(values))
+    return evaluate(values[1]) if evaluate(values[0]) else evaluate(values[2])
+
+
+def logic_not(evaluate, values):
+    '''
+    JSON Logic "!"
+    :param evaluate: function that evaluates a value
+    :param values:
+    :return:
+    '''
+    if len(values) != 1:
+        raise TypeError("! takes exactly 1 argument (%d given)" % len(values))
+    return not evaluate(values[0])
+
+
+# JSON Logic operations that evaluate their values only as far as needed.
+short_circuit_operations = {
+    "and": logic_and,
+    "or": logic_or,
+    "?:": logic_if,
+    "!": logic_not
+}
+
+
 def get_value_from_object(traversable_object, value_string, not_found=None):
     '''
     given a traversable object, returns the value from within it. Can be used to traverse multiple levels inside it.
@@ -258,6 +440,25 @@ def get_value_from_object(traversable_object, value_string, not_found=None):
         return not_found
 
 
+def get_value_from_keys(traversable_object, keys, not_found=None):
+    '''
+    Same as get_value_from_object, for a path that has already been split into keys. Errors are not suppressed, as
+    in the "var" operation of JSON Logic.
+    :param traversable_object:
+    :param keys:
+    :param not_found:
+    :return:
+    '''
+    for key in keys:
+        if type(traversable_object) == dict:
+            traversable_object = traversable_object.get(key, not_found)
+        elif type(traversable_object) in [list, tuple]:
+            traversable_object = traversable_object[int(key)]
+        else:
+            traversable_object = not_found
+    return traversable_object
+
+
 def set_value_in_object(traversable_object, reference_string, value, not_found=None):
     reference_string_split = str(reference_string).split(".")
     to_set = get_value_from_object(traversable_object, "".join(reference_string_split[:len(reference_string_split)-1]))
@@ -271,16 +472,68 @@ def cosine_similarity(vec1, vec2):
     return 1 - spatial.distance.cosine(vec1, vec2)
 
 
+class MappingCache:
+    # A per-process LRU of decoded mappings and tokenized mappings, bounded by the total size of their encoded values.
+    # Every value is cached with the version of its mapping in redis ("version" + map name) and is reloaded only when
+    # that version changes.
+
+    def __init__(self, max_size=256 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        # key -> (version, encoded size, decoded value)
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, redis_object, key, version):
+        '''
+        returns the decoded json value of a redis key, or None if it is not set. The cached value is used if it was
+        loaded at the given version. Values without a version are not cached, since they cannot be revalidated
+        :param redis_object:
+        :param key:
+        :param version:
+        :return:
+        '''
+        cached = self.values.pop(key, None)
+        if cached:
+            self.size -= cached[1]
+            if version is not None and cached[0] == version:
+                self.hits += 1
+                # most recently used go last
+                self.values[key] = cached
+                self.size += cached[1]
+                return cached[2]
+        self.misses += 1
+        encoded = redis_object.get(key)
+        if not encoded:
+            return None
+        value = json.loads(encoded)
+        if version is not None and len(encoded) <= self.max_size:
+            self.values[key] = (version, len(encoded), value)
+            self.size += len(encoded)
+            # evict the least recently used
+            while self.size > self.max_size:
+                evicted = self.values.popitem(last=False)[1]
+                self.size -= evicted[1]
+        return value
+
+
+# one redis connection pool and mapping cache per process
+redis_pool = redis.ConnectionPool(host="localhost", port=6379, encoding="utf-8", decode_responses=True)
+mapping_cache = MappingCache()
+
+
 def perform_extraction(ex_obj, data):
     '''
     This function can be used to extract information from a message and store it for usage.
     It returns true if any of desired information is found. Otherwise, it returns False.
+    Mappings are read through the mapping cache and are not decoded again unless their version changes.
     :param ex_obj:
     :param data:
     :return:
     '''
-    # form a redis connection to get mapping from
-    r = redis.StrictRedis(host="localhost", port=6379, charset="utf-8", decode_responses=True)
+    # get a redis connection from the pool to get mapping from
+    r = redis.StrictRedis(connection_pool=redis_pool)
     data_found = False
     data["context"]["extraction"] = data["context"].get("extraction", {})
     # get message
@@ -295,21 +548,67 @@ def perform_extraction(ex_obj, data):
             # check if the mapping has already been tapped into.
             if map_name not in data["context"]["extraction"]:
                 # retrieve mapping
-                mapping = r.get(map_name)
-                tokenized_mapping = r.get("tokenized" + map_name)
+                version = r.get("version" + map_name)
+                index = data["extraction_indices"][map_name]
+                tokenized_mapping = None
+                if index.mapping_storage == "hash":
+                    # the entries are fetched later, only for the candidates
+                    mapping = mapping_cache.get(r, "meta" + map_name, version)
+                else:
+                    mapping = mapping_cache.get(r, map_name, version)
+                    # the tokenized mapping is only needed if there is no phrase index
+                    if index.phrase_index is None:
+                        tokenized_mapping = mapping_cache.get(r, "tokenized" + map_name, version)
                 # TODO if below check fails, use function call to regenerate and populate mappings and tokenized mappings
                 # TODO probably do it where the graph object will be available.
-                if mapping and tokenized_mapping:
-                    mapping = json.loads(mapping)
-                    tokenized_mapping = json.loads(tokenized_mapping)
+                if mapping is not None and index.mapping_storage == "hash":
+                    # shorten the list using index and fetch the candidate entries
+                    num_entries = mapping["num_entries"]
+                    doc_ids = get_candidate_doc_ids(message, index, xrange(num_entries), data.setdefault("normalised_text", {}))
+                    if not doc_ids:
+                        # no entry shares a token with the message, so none can be found in it
+                        extracted_data = []
+                    elif index.phrase_index is not None:
+                        shortened_mapping = get_mapping_entries(r, "entries" + map_name, doc_ids)
+                        # entries missing from the hash are skipped
+                        doc_ids = [doc_id for doc_id, entry in zip(doc_ids, shortened_mapping) if entry is not None]
+                        shortened_mapping = [entry for entry in shortened_mapping if entry is not None]
+                        # perform a "multi" extraction
+                        extracted_data = find_occurrences(message, shortened_mapping, None, "multi", data["normalised_text"], index.phrase_index, doc_ids)
+                    else:
+                        entries = get_mapping_entries(r, "entries" + map_name, doc_ids)
+                        tokenized_entries = get_mapping_entries(r, "tokenizedentries" + map_name, doc_ids)
+                        # entries missing from the hash are skipped
+                        shortened_mapping = []
+                        shortened_tokenized_mapping = []
+                        for entry, tokenized_entry in zip(entries, tokenized_entries):
+                            if entry is not None and tokenized_entry is not None:
+                                shortened_mapping.append(entry)
+                                shortened_tokenized_mapping.append(tokenized_entry)
+                        # perform a "multi" extraction
+                        extracted_data = find_occurrences(message, shortened_mapping, shortened_tokenized_mapping, "multi", data["normalised_text"])
+                    # set extracted values in object to prevent repeated extraction
+                    data["context"]["extraction"][map_name] = extracted_data
+                elif mapping is not None and index.phrase_index is not None:
+                    entries = mapping.get("map", []) or []
+                    # shorten the list using index and look the n grams up in the phrase index
+                    doc_ids = get_candidate_doc_ids(message, index, entries, data.setdefault("normalised_text", {}))
+                    shortened_mapping = entries if doc_ids is None else [entries[i] for i in doc_ids]
+                    # perform a "multi" extraction
+                    extracted_data = find_occurrences(message, shortened_mapping, None, "multi", data["normalised_text"], index.phrase_index, doc_ids)
+                    # set extracted values in object to prevent repeated extraction
+                    data["context"]["extraction"][map_name] = extracted_data
+                elif mapping is not None and tokenized_mapping is not None:
                     # shorten the list using index
-                    shortened_mapping, shortened_tokenized_mapping = shorten_mapping(message, data["extraction_indices"][map_name], mapping.get("map", []) or [], tokenized_mapping)
+                    shortened_mapping, shortened_tokenized_mapping = shorten_mapping(message, index, mapping.get("map", []) or [], tokenized_mapping, data.setdefault("normalised_text", {}))
                     # perform a "multi" extraction
-                    extracted_data = find_occurrences(message, shortened_mapping, shortened_tokenized_mapping, "multi")
+                    extracted_data = find_occurrences(message, shortened_mapping, shortened_tokenized_mapping, "multi", data["normalised_text"])
                     # set extracted values in object to prevent repeated extraction
                     data["context"]["extraction"][map_name] = extracted_data
             else:
-                mapping = json.loads(r.get(map_name))
+                index = data["extraction_indices"].get(map_name)
+                mapping_key = "meta" + map_name if index is not None and index.mapping_storage == "hash" else map_name
+                mapping = mapping_cache.get(r, mapping_key, r.get("version" + map_name))
                 extracted_data = data["context"]["extraction"][map_name]
             # all fields for the current map will be set. If there is no extracted value, the value shall be None
             to_set = element.get("setex", []) or [{"key": mapping["default_set_key"], "r_type": "multi"}]
@@ -337,44 +636,111 @@ def perform_extraction(ex_obj, data):
     return False
 
 
-def shorten_mapping(clean_string, index, mapping, tokenized_mapping):
+def get_mapping_entries(redis_object, key, entry_ids):
     '''
-    Shortens the incoming map using input string. This is done by using the given index.
-    This improves performance as there are lesser entries to check against.
+    returns the decoded entries at the given indices of a mapping stored as a redis hash
+    :param redis_object:
+    :param key:
+    :param entry_ids:
+    :return:
+    '''
+    if not entry_ids:
+        return []
+    return [json.loads(entry) if entry else None for entry in redis_object.hmget(key, entry_ids)]
+
+
+def get_candidate_doc_ids(clean_string, index, mapping, turn_cache=None):
+    '''
+    returns the sorted ids of the mapping entries that share a token with the input string, looked up in the given
+    index. Returns None if the mapping cannot be shortened
     :param clean_string:
     :param index:
-    :param mapping:
-    :param tokenized_mapping:
+    :param mapping: the mapping entries, or an xrange over their indices
+    :param turn_cache: per-turn cache of normalised texts
     :return:
     '''
     if clean_string and index and mapping:
-        tokens = lemmatize_text(clean_string)
-        doc_set = set()
+        tokens = lemmatize_text(clean_string, turn_cache)
+        num_entries = len(mapping)
+        # a bitmap of the entries, OR-ed with the docs of every token
+        candidates = numpy.zeros(num_entries, dtype=bool)
         for token in tokens:
             token_obj = index.get_token(token)
             if token_obj:
-                doc_set = doc_set.union(token_obj.get_doc_id_set())
-        shortened_mapping = [x for i, x in enumerate(mapping) if i in doc_set]
-        shortened_tokenized_mapping = [x for i, x in enumerate(tokenized_mapping) if i in doc_set]
-        return shortened_mapping, shortened_tokenized_mapping
-    return mapping, tokenized_mapping
+                doc_ids = token_obj.get_doc_id_array()
+                candidates[doc_ids[(doc_ids >= 0) & (doc_ids < num_entries)]] = True
+        return numpy.flatnonzero(candidates).tolist()
+    return None
 
 
-def find_occurrences(clean_string, mapping, tokenized_mapping, r_type="best"):
+def shorten_mapping(clean_string, index, mapping, tokenized_mapping, turn_cache=None):
+    '''
+    Shortens the incoming map using input string. This is done by using the given index.
+    This improves performance as there are lesser entries to check against.
+    :param clean_string:
+    :param index:
+    :param mapping:
+    :param tokenized_mapping:
+    :param turn_cache: per-turn cache of normalised texts
+    :return:
+    '''
+    doc_ids = get_candidate_doc_ids(clean_string, index, mapping, turn_cache)
+    if doc_ids is None:
+        return mapping, tokenized_mapping
+    shortened_mapping = [mapping[i] for i in doc_ids]
+    num_tokenized_entries = len(tokenized_mapping)
+    shortened_tokenized_mapping = [tokenized_mapping[i] for i in doc_ids if i < num_tokenized_entries]
+    return shortened_mapping, shortened_tokenized_mapping
+
+
+class PhraseIndex:
+    # Maps the sorted tokens of every element of a tokenized mapping to the ids of the entries that have it, so
+    # that an n gram is found with one lookup instead of a scan of the whole mapping
+
+    def __init__(self, tokenized_mapping):
+        self.phrases = dict()
+        self.max_length = 0
+        for ind, elements in enumerate(tokenized_mapping):
+            if not elements:
+                continue
+            for element in elements:
+                phrase = tuple(element)
+                entry_ids = self.phrases.setdefault(phrase, [])
+                # ids are in ascending order and each entry is listed once
+                if not entry_ids or entry_ids[-1] != ind:
+                    entry_ids.append(ind)
+                self.max_length = max(self.max_length, len(phrase))
+
+    def get_entry_ids(self, sorted_tokens):
+        return self.phrases.get(tuple(sorted_tokens), [])
+
+
+def find_occurrences(clean_string, mapping, tokenized_mapping, r_type="best", turn_cache=None, phrase_index=None, doc_ids=None):
     '''
     returns occurrences of mapping contents from inside the clean_string. response is per the specified type
     :param clean_string:
     :param mapping:
     :param tokenized_mapping:
     :param r_type:
+    :param turn_cache: per-turn cache of normalised texts
+    :param phrase_index: PhraseIndex of the full mapping. If given, n grams are looked up in it and tokenized_mapping
+    is not used
+    :param doc_ids: ids of the entries of the full mapping that mapping was shortened to, as returned by
+    get_candidate_doc_ids. None if mapping is the full mapping
     :return:
     '''
-    if clean_string and mapping and tokenized_mapping:
+    if clean_string and mapping and (tokenized_mapping or phrase_index is not None):
         # 'found' is a dict of the indices and corresponding occurrences
         found = dict()
-        tokens = lemmatize_text(clean_string)
+        tokens = lemmatize_text(clean_string, turn_cache)
         # the max n grams for the string will be dictated by the num of tokens
         num_tokens = len(tokens)
+        if phrase_index is not None:
+            # no element is longer than the longest phrase
+            num_tokens = min(num_tokens, phrase_index.max_length)
+            # positions of the entries of the full mapping in mapping
+            num_entries = len(mapping)
+            positions = dict((doc_id, pos) for pos, doc_id in enumerate(doc_ids)) if doc_ids is not None else None
         for i in xrange(1, num_tokens+1):
             # generate an i gram for the token
             i_grams = ngrams(tokens, i)
@@ -382,9 +748,12 @@ def find_occurrences(clean_string, mapping, tokenized_mapping, r_type="best"):
             for pos, i_gram in enumerate(i_grams):
                 # sort the i gram
                 sorted_i_gram = sorted(i_gram)
-                # TODO optimise this. use dict and only compare i grams using i as a key in the dict.
-                # TODO contd.. put it while creating the tokenized map
-                found_indices = [ind for ind, x in enumerate(tokenized_mapping) if x and sorted_i_gram in x]
+                if phrase_index is None:
+                    found_indices = [ind for ind, x in enumerate(tokenized_mapping) if x and sorted_i_gram in x]
+                elif positions is None:
+                    found_indices = [ind for ind in phrase_index.get_entry_ids(sorted_i_gram) if ind < num_entries]
+                else:
+                    found_indices = [positions[ind] for ind in phrase_index.get_entry_ids(sorted_i_gram) if ind in positions]
                 # TODO Later, deal with overlapping entries being found
                 # for each found index, set value in dict
                 for ind in found_indices: